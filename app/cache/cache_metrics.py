@@ -0,0 +1,107 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List, Tuple
+
+# upper bounds of the latency buckets in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS_MS: Tuple[float, ...] = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram. Observations are in seconds, the snapshot is in milliseconds.
+    """
+
+    def __init__(self, buckets_ms: Tuple[float, ...] = LATENCY_BUCKETS_MS):
+        self._buckets_ms = buckets_ms
+        self._counts: List[int] = [0] * (len(buckets_ms) + 1)
+        self._count = 0
+        self._sum_ms = 0.0
+        self._max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self._counts[bisect.bisect_left(self._buckets_ms, ms)] += 1
+        self._count += 1
+        self._sum_ms += ms
+        self._max_ms = max(self._max_ms, ms)
+
+    def snapshot(self) -> dict:
+        buckets = {f"le_{bound:g}ms": count for bound, count in zip(self._buckets_ms, self._counts)}
+        buckets['inf'] = self._counts[-1]
+        return {
+            'count': self._count,
+            'avg_ms': round(self._sum_ms / self._count, 3) if self._count else None,
+            'max_ms': round(self._max_ms, 3),
+            'buckets': buckets,
+        }
+
+
+class CacheMetrics:
+    """
+    Counters and latency histograms of one cache, registered by name so /metrics/caches can report all of them.
+    Updated from the event loop and from writer threads.
+    """
+    _registry: Dict[str, 'CacheMetrics'] = {}
+
+    def __init__(self, name: str):
+        self.name = name
+        self._counters: Dict[str, int] = {}
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_cache(cls, name: str) -> 'CacheMetrics':
+        if name not in cls._registry:
+            cls._registry[name] = cls(name)
+        return cls._registry[name]
+
+    @classmethod
+    def snapshot_all(cls) -> Dict[str, dict]:
+        return {name: metrics.snapshot() for name, metrics in cls._registry.items()}
+
+    def inc(self, counter: str, value: int = 1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def record_lookups(self, hits: int, misses: int):
+        with self._lock:
+            self._counters['hits'] = self._counters.get('hits', 0) + hits
+            self._counters['misses'] = self._counters.get('misses', 0) + misses
+
+    def observe(self, histogram: str, seconds: float):
+        with self._lock:
+            if histogram not in self._histograms:
+                self._histograms[histogram] = LatencyHistogram()
+            self._histograms[histogram].observe(seconds)
+
+    @contextmanager
+    def timed(self, histogram: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(histogram, time.perf_counter() - t0)
+
+    @asynccontextmanager
+    async def locked(self, lock: asyncio.Lock):
+        """
+        Acquire lock, recording the time spent waiting for it in the lock_wait histogram.
+        """
+        t0 = time.perf_counter()
+        async with lock:
+            self.observe('lock_wait', time.perf_counter() - t0)
+            yield
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {name: histogram.snapshot() for name, histogram in self._histograms.items()}
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        return {
+            'counters': counters,
+            'hit_ratio': round(counters.get('hits', 0) / lookups, 4) if lookups else None,
+            'latency': histograms,
+        }
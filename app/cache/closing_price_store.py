@@ -0,0 +1,219 @@
+import csv
+import glob
+import logging
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+# (symbol, date, ib_close, refinitiv_close, ib_snapshot, ib_bar_close) - missing values are stored as None
+PriceRow = Tuple[str, str, Optional[float], Optional[float], Optional[float], Optional[float]]
+
+COLUMNS = ['symbol', 'ib_close', 'refinitiv_close', 'ib_snapshot', 'ib_bar_close']
+DTYPES = {'ib_close': 'float64', 'refinitiv_close': 'float64', 'ib_snapshot': 'float64', 'ib_bar_close': 'float64'}
+
+STORAGE_DIR = os.path.join(os.path.dirname(__file__), "storage")
+
+
+class ClosingPriceStore:
+    """
+    Persistence backend for ClosingPriceCache. Rows are keyed by (symbol, date) and read one trading day at a time.
+    """
+    bytes_written = 0  # cumulative bytes written by upsert, reported by the cache metrics
+
+    def dates(self) -> List[str]:
+        """
+        Return the stored trading days in ascending order.
+        """
+        raise NotImplementedError
+
+    def load_day(self, date: str) -> pd.DataFrame:
+        """
+        Return the rows stored for a trading day as a DataFrame with COLUMNS; missing prices are NaN.
+        """
+        raise NotImplementedError
+
+    def upsert(self, rows: Iterable[PriceRow]) -> int:
+        """
+        Insert or replace the given rows as a single batch and return the number of rows written.
+        """
+        raise NotImplementedError
+
+    def purge_before(self, date: str) -> int:
+        """
+        Drop every trading day older than date and return the number of days removed.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def is_empty(self) -> bool:
+        return not self.dates()
+
+    def latest_date(self) -> Optional[str]:
+        dates = self.dates()
+        return dates[-1] if dates else None
+
+    def import_legacy_csv(self, csv_path: str, since: str = '') -> int:
+        """
+        One-off import of the append-only closing_prices_log.csv, skipping days before since.
+        Later lines win over earlier ones.
+        """
+        if not os.path.exists(csv_path) or not self.is_empty():
+            return 0
+
+        rows: Dict[Tuple[str, str], PriceRow] = {}
+        with open(csv_path, mode='r', newline='') as file:
+            for row in csv.DictReader(file):
+                if row['date'] < since:
+                    continue
+                ib_close = float(row['ib_close']) if row['ib_close'] != "" else None
+                refinitiv_close = float(row['refinitiv_close']) if row['refinitiv_close'] != "" else None
+                rows[(row['symbol'], row['date'])] = (row['symbol'], row['date'], ib_close, refinitiv_close, None, None)
+
+        count = self.upsert(rows.values())
+        if count:
+            logging.info(f"Imported {count} rows from legacy closing prices log {csv_path}")
+        return count
+
+
+class SQLiteClosingPriceStore(ClosingPriceStore):
+    """
+    SQLite store in WAL mode. A batch of upserts is committed in one transaction (one fsync).
+    """
+
+    def __init__(self, db_path: str = os.path.join(STORAGE_DIR, "closing_prices.db")):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db_path = db_path
+        # writes are issued from a worker thread, reads from the event loop thread
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        with self._conn_lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS closing_prices (
+                        symbol TEXT NOT NULL,
+                        date TEXT NOT NULL,
+                        ib_close REAL,
+                        refinitiv_close REAL,
+                        ib_snapshot REAL,
+                        ib_bar_close REAL,
+                        PRIMARY KEY (symbol, date)
+                    ) WITHOUT ROWID
+                """)
+                columns = {row[1] for row in self._conn.execute("PRAGMA table_info(closing_prices)")}
+                for column in ('ib_snapshot', 'ib_bar_close'):
+                    if column not in columns:
+                        self._conn.execute(f"ALTER TABLE closing_prices ADD COLUMN {column} REAL")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS idx_closing_prices_date ON closing_prices (date)")
+        logging.info(f"Opened closing prices store {db_path}")
+
+    def dates(self) -> List[str]:
+        with self._conn_lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT date FROM closing_prices ORDER BY date")]
+
+    def load_day(self, date: str) -> pd.DataFrame:
+        with self._conn_lock:
+            return pd.read_sql_query(
+                "SELECT symbol, ib_close, refinitiv_close, ib_snapshot, ib_bar_close "
+                "FROM closing_prices WHERE date = ?",
+                self._conn, params=(date,), dtype=DTYPES)
+
+    def upsert(self, rows: Iterable[PriceRow]) -> int:
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self._conn_lock, self._conn:
+            self._conn.executemany("""
+                INSERT INTO closing_prices (symbol, date, ib_close, refinitiv_close, ib_snapshot, ib_bar_close)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (symbol, date) DO UPDATE SET
+                    ib_close = excluded.ib_close,
+                    refinitiv_close = excluded.refinitiv_close,
+                    ib_snapshot = excluded.ib_snapshot,
+                    ib_bar_close = excluded.ib_bar_close
+            """, rows)
+        # page-level writes are not exposed by sqlite, count the row payload instead
+        self.bytes_written += sum(len(symbol) + len(date) + 32 for symbol, date, *_ in rows)
+        return len(rows)
+
+    def purge_before(self, date: str) -> int:
+        with self._conn_lock, self._conn:
+            days = self._conn.execute(
+                "SELECT COUNT(DISTINCT date) FROM closing_prices WHERE date < ?", (date,)).fetchone()[0]
+            self._conn.execute("DELETE FROM closing_prices WHERE date < ?", (date,))
+        return days
+
+    def close(self):
+        with self._conn_lock:
+            self._conn.close()
+
+
+class ParquetClosingPriceStore(ClosingPriceStore):
+    """
+    Columnar store with one Parquet file per trading day. An upsert rewrites each touched day once,
+    through a temporary file that atomically replaces the previous partition.
+    """
+
+    def __init__(self, root_dir: str = os.path.join(STORAGE_DIR, "closing_prices")):
+        os.makedirs(root_dir, exist_ok=True)
+        self._root_dir = root_dir
+        logging.info(f"Opened closing prices store {root_dir}")
+
+    def _day_path(self, date: str) -> str:
+        return os.path.join(self._root_dir, f"{date}.parquet")
+
+    def dates(self) -> List[str]:
+        paths = glob.glob(os.path.join(self._root_dir, "*.parquet"))
+        return sorted(os.path.basename(path)[:-len(".parquet")] for path in paths)
+
+    def load_day(self, date: str) -> pd.DataFrame:
+        path = self._day_path(date)
+        if not os.path.exists(path):
+            return pd.DataFrame({'symbol': pd.Series(dtype='object'),
+                                 **{column: pd.Series(dtype=dtype) for column, dtype in DTYPES.items()}})
+        # partitions written before a column existed lack it
+        return pd.read_parquet(path).reindex(columns=COLUMNS).astype(DTYPES)
+
+    def upsert(self, rows: Iterable[PriceRow]) -> int:
+        by_date: Dict[str, List[PriceRow]] = defaultdict(list)
+        for row in rows:
+            by_date[row[1]].append(row)
+
+        count = 0
+        for date, day_rows in by_date.items():
+            updates = pd.DataFrame([(symbol, *values) for symbol, _, *values in day_rows],
+                                   columns=COLUMNS).astype(DTYPES)
+            existing = self.load_day(date)
+            if not existing.empty:
+                existing = existing[~existing['symbol'].isin(updates['symbol'])]
+                updates = pd.concat([existing, updates], ignore_index=True)
+            updates = updates.drop_duplicates(subset='symbol', keep='last')
+
+            path = self._day_path(date)
+            tmp_path = f"{path}.tmp"
+            updates.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            self.bytes_written += os.path.getsize(path)
+            count += len(day_rows)
+        return count
+
+    def purge_before(self, date: str) -> int:
+        expired = [day for day in self.dates() if day < date]
+        for day in expired:
+            os.remove(self._day_path(day))
+        return len(expired)
+
+
+def create_closing_price_store(kind: str) -> ClosingPriceStore:
+    if kind == 'parquet':
+        return ParquetClosingPriceStore()
+    if kind == 'sqlite':
+        return SQLiteClosingPriceStore()
+    raise ValueError(f"Unknown closing price store: {kind}")
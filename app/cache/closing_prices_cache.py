@@ -1,29 +1,43 @@
 import asyncio
-import csv
 import logging
+import math
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date as date_type, timedelta
+from typing import Dict, Iterable, List, Mapping, Optional, Union
 
 import pandas as pd
 
+from app.cache.cache_metrics import CacheMetrics
+from app.cache.closing_price_store import ClosingPriceStore, create_closing_price_store
+from app.cache.price_table import FIELDS, PriceTable
+from app.cache.warm_up import CacheWarmUp
 from app.config import APP
 
 
+def _to_date_str(date) -> str:
+    return date.strftime('%Y-%m-%d') if isinstance(date, date_type) else str(date)
+
+
+def _to_float(price) -> Optional[float]:
+    return None if price is None or price == "" or pd.isna(price) else float(price)
+
+
 class ClosingPriceCache:
     _instance = None
     _lock = asyncio.Lock()
-    _csv_path = os.path.join(os.path.dirname(__file__), "storage", "closing_prices_log.csv")
+    _legacy_csv_path = os.path.join(os.path.dirname(__file__), "storage", "closing_prices_log.csv")
 
-    def __init__(self):
+    def __init__(self, store: ClosingPriceStore = None):
         logging.info("Initializing Closing Price Cache...")
-        self._cache = {}  # { "symbol": { "ib_close": float, "refinitiv_close": float, "date": str } }
+        self._days: Dict[str, PriceTable] = {}  # { "date": PriceTable }
         self._cache_lock = asyncio.Lock()
-        if self._load_cache():
-            first_symbol, first_record = next(iter(self._cache.items()))
-            self._last_updated = datetime.strptime(first_record["date"], "%Y-%m-%d").date()
-            logging.info(f"Closing Price Cache last updated on {self._last_updated}")
-        else:
-            self._last_updated = None
+        self._store = store if store else create_closing_price_store(APP.conf.closing_price_store)
+        # single writer thread keeps batches in submission order and off the event loop
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="closing-price-store")
+        self._last_updated = None
+        self._metrics = CacheMetrics.for_cache("closing_prices")
+        self._warm_up = CacheWarmUp("Closing Price Cache", self._load_cache)
 
     @classmethod
     def instance(cls):
@@ -31,121 +45,278 @@ class ClosingPriceCache:
             cls._instance = ClosingPriceCache()
         return cls._instance
 
+    @property
+    def warm_up(self) -> CacheWarmUp:
+        return self._warm_up
+
+    @property
+    def metrics(self) -> CacheMetrics:
+        return self._metrics
+
+    @property
+    def _cache(self) -> PriceTable:
+        """
+        Prices of the current trading day.
+        """
+        date = _to_date_str(APP.conf.last_trading_day)
+        return self._days.setdefault(date, PriceTable(date))
+
     def _is_cache_expired(self):
-        return self._last_updated is not None and APP.conf.last_trading_day > self._last_updated
+        return APP.conf.last_trading_day > self._last_updated
 
     def _load_cache(self) -> bool:
-        row_count = 0
-
-        if os.path.exists(self._csv_path):
-            with open(self._csv_path, mode='r', newline='') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    symbol = row['symbol']
-                    entry = {
-                        'ib_close': float(row['ib_close']) if row['ib_close'] != "" else pd.NA,
-                        'refinitiv_close': float(row['refinitiv_close']) if row['refinitiv_close'] != ""  else pd.NA,
-                        'date': row['date'],
-                    }
-                    self._cache[symbol] = entry
-                    row_count += 1
-
-                if row_count > 0:
-                    logging.info(f"Loaded {row_count} entries into Closing Price Cache")
+        self._last_updated = APP.conf.last_trading_day
+        self._store.import_legacy_csv(self._legacy_csv_path, since=self._retention_cutoff())
+        self._apply_retention()
+
+        # only the current trading day is loaded, so startup does not depend on how much history is stored
+        trading_day = _to_date_str(APP.conf.last_trading_day)
+        self._days[trading_day] = PriceTable.from_frame(trading_day, self._store.load_day(trading_day))
+        if self._days[trading_day]:
+            logging.info(f"Loaded {len(self._days[trading_day])} entries for {trading_day} into Closing Price Cache")
         else:
-            logging.info(f"Cache is not yet created")
+            logging.info(f"Cache is not yet created for {trading_day}, latest stored day is {self._store.latest_date()}")
+        return len(self._days[trading_day]) > 0
+
+    def _retention_cutoff(self) -> str:
+        return _to_date_str(APP.conf.last_trading_day - timedelta(days=APP.conf.closing_price_retention_days))
+
+    def _apply_retention(self):
+        cutoff = self._retention_cutoff()
+        self._evict_days_before(cutoff)
+        self._purge_store(cutoff)
+
+    def _evict_days_before(self, cutoff: str):
+        for day in [day for day in self._days if day < cutoff]:
+            del self._days[day]
 
-        return row_count > 0
+    def _purge_store(self, cutoff: str):
+        removed = self._store.purge_before(cutoff)
+        if removed:
+            logging.info(f"Removed {removed} trading days older than {cutoff} from Closing Price Cache")
 
     async def _reset_if_expired(self):
+        # history is kept per trading day, a new trading day only triggers the retention policy
         if self._is_cache_expired():
-            async with self._cache_lock:
-                logging.warning("Clean cache ==> expired!")
-                self._cache.clear()
-                if os.path.exists(self._csv_path):
-                    os.remove(self._csv_path)
-                self._last_updated = APP.conf.last_trading_day
+            async with self._metrics.locked(self._cache_lock):
+                if self._is_cache_expired():
+                    logging.info(f"Trading day advanced from {self._last_updated} to {APP.conf.last_trading_day}")
+                    self._metrics.inc('expired_resets')
+                    cutoff = self._retention_cutoff()
+                    self._evict_days_before(cutoff)
+                    await asyncio.get_running_loop().run_in_executor(self._writer, self._purge_store, cutoff)
+                    self._last_updated = APP.conf.last_trading_day
+
+    async def _ensure_day_loaded(self, date: str) -> PriceTable:
+        """
+        Return the in-memory partition of a trading day, reading it from the store on first access.
+        Must be called while holding _cache_lock.
+        """
+        if date not in self._days:
+            with self._metrics.timed('store_load'):
+                day_df = await asyncio.to_thread(self._store.load_day, date)
+            self._days[date] = PriceTable.from_frame(date, day_df)
+            logging.info(f"Loaded {len(self._days[date])} entries for {date} from store")
+        return self._days[date]
 
     async def set_refinitiv_close(self, symbol: str, close_price: float, date: str):
-        await self._reset_if_expired()
-        async with self._cache_lock:
-            if symbol not in self._cache:
-                self._cache[symbol] = {'date': date}
-            csv_value = close_price if pd.notna(close_price) else ""
-            # if cache was loaded when service started then self._cache[symbol]['refinitiv_close'] may contains pd.NA values
-            # so befor compare we need convert it to "" if it's pd.NA
-            if 'refinitiv_close' not in self._cache[symbol] or pd.isna(self._cache[symbol]['refinitiv_close']):
-                cache_value = ""
-            else:
-                cache_value = self._cache[symbol]['refinitiv_close']
-            if cache_value != csv_value:
-                self._cache[symbol]['refinitiv_close'] = csv_value
-                self._cache[symbol]['date'] = date
-                logging.debug(f"Set Refinitiv close for {symbol}")
-                await self._maybe_log_to_csv(symbol)
-            else:
-                logging.info(f"{symbol} already exists in cache with the same Refinitive price={close_price}")
+        await self.set_refinitiv_closes({symbol: close_price}, date)
 
     async def set_ib_close(self, symbol: str, close_price: float, date: str):
-        async with self._cache_lock:
-            await self._reset_if_expired()
-            if symbol not in self._cache:
-                self._cache[symbol] = {'date': date}
-            if 'ib_close' not in self._cache[symbol] or self._cache[symbol]['ib_close'] != close_price:
-                self._cache[symbol]['ib_close'] = close_price
-                self._cache[symbol]['date'] = date
-                logging.debug(f"Set IB close for {symbol}")
-                await self._maybe_log_to_csv(symbol)
-            else:
-                logging.info(f"{symbol} already exists in cache with the same IB price={close_price}")
-
-    async def _maybe_log_to_csv(self, symbol: str):
-        data = self._cache.get(symbol, {})
-        if all(k in data for k in ('refinitiv_close', 'ib_close', 'date')):
-            row = [data['date'], symbol, data['ib_close'], data['refinitiv_close']]
-
-            needs_header = False
-            dir_path = os.path.dirname(self._csv_path)
-            if dir_path and not os.path.exists(dir_path):
-                os.makedirs(dir_path, exist_ok=True)
-                needs_header = True
-
-            if (not os.path.exists(self._csv_path)) or (os.path.getsize(self._csv_path) == 0):
-                needs_header = True
-
-            with open(self._csv_path, mode="a", newline="") as csvfile:
-                writer = csv.writer(csvfile)
-                if needs_header:
-                    writer.writerow(['date', 'symbol', 'ib_close', 'refinitiv_close'])
-                writer.writerow(row)
-                logging.info(f"Logged prices for {symbol} on {data['date']}")
-
-    async def get_prices(self, symbol: str):
-        async with self._cache_lock:
-            return self._cache.get(symbol, None)
+        await self.set_ib_closes({symbol: close_price}, date)
+
+    async def set_refinitiv_closes(self, prices: Union[Mapping[str, float], pd.Series], date: str):
+        await self._set_many({'refinitiv_close': prices}, date)
+
+    async def set_ib_closes(self, prices: Union[Mapping[str, float], pd.Series], date: str):
+        await self._set_many({'ib_close': prices}, date)
+
+    async def set_many(self, prices: pd.DataFrame, date: str):
+        """
+        prices is indexed by symbol and holds an 'ib_close' and/or 'refinitiv_close' column.
+        """
+        await self._set_many({field: prices[field] for field in FIELDS if field in prices.columns}, date)
+
+    async def _set_many(self, updates: Dict[str, Union[Mapping[str, float], pd.Series]], date: str):
+        """
+        Apply batches of prices ({ field: prices }) under a single lock acquisition and persist the changed
+        symbols as one write.
+        """
+        await self._warm_up.wait_ready()
+        await self._reset_if_expired()
+        date = _to_date_str(date)
+        pending = None
+        async with self._metrics.locked(self._cache_lock):
+            day = await self._ensure_day_loaded(date)
+            changed = {}
+            for field, prices in updates.items():
+                field_changed = day.set_many(field, prices)
+                changed.update(dict.fromkeys(field_changed))
+                logging.info(f"Set {field} for {len(field_changed)} of {len(prices)} symbols on {date}")
+            if changed:
+                self._metrics.inc('writes', len(changed))
+                pending = self._persist(day, list(changed))
+        if pending:
+            await pending
+
+    def _persist(self, day: PriceTable, symbols: List[str]) -> asyncio.Future:
+        """
+        Snapshot the given symbols and hand them to the writer thread as one batch.
+        Must be called while holding _cache_lock; the returned future can be awaited after releasing it.
+        """
+        columns = zip(*[day.values(field, symbols).tolist() for field in FIELDS])
+        rows = [(symbol, day.date, *[_to_float(value) for value in values]) for symbol, values in zip(symbols, columns)]
+        return asyncio.get_running_loop().run_in_executor(self._writer, self._write_rows, rows)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._store.close)
+        self._writer.shutdown(wait=True)
+
+    def _write_rows(self, rows):
+        try:
+            bytes_before = self._store.bytes_written
+            with self._metrics.timed('persist'):
+                count = self._store.upsert(rows)
+            self._metrics.inc('rows_persisted', count)
+            self._metrics.inc('bytes_persisted', self._store.bytes_written - bytes_before)
+            logging.info(f"Persisted {count} closing price rows")
+        except Exception as e:
+            self._metrics.inc('persist_errors')
+            logging.error(f"Error persisting closing prices: {e}")
 
     async def fetch(self, symbol: str):
-        async with self._cache_lock:
-            return self._cache.get(symbol, None)
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            entry = self._cache.get(symbol)
+        self._metrics.record_lookups(entry is not None, entry is None)
+        return entry
 
     async def get_all(self):
-        async with self._cache_lock:
-            return dict(self._cache)
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            table = self._cache
+            return {symbol: table.get(symbol) for symbol in table.index}
 
     async def ib_price_exists(self, symbol) -> bool:
-        async with self._cache_lock:
-            if symbol in self._cache and 'ib_close' in self._cache[symbol]:
-                return True
-        return False
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            entry = self._cache.get(symbol)
+            return entry is not None and 'ib_close' in entry
 
     async def refinitiv_price_exists(self, symbol) -> bool:
-        async with self._cache_lock:
-            if symbol in self._cache and 'refinitiv_close' in self._cache[symbol]:
-                return True
-        return False
-
-    async def get_prices(self, symbol):
-        async with self._cache_lock:
-            if symbol in self._cache and 'ib_close' in self._cache[symbol]:
-                return self._cache[symbol]
-        return None
\ No newline at end of file
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            entry = self._cache.get(symbol)
+            return entry is not None and 'refinitiv_close' in entry
+
+    async def get_prices(self, symbol, date=None):
+        await self._warm_up.wait_ready()
+        date = _to_date_str(date if date else APP.conf.last_trading_day)
+        async with self._metrics.locked(self._cache_lock):
+            day = await self._ensure_day_loaded(date)
+            entry = day.get(symbol)
+        if entry and 'ib_close' in entry:
+            self._metrics.record_lookups(1, 0)
+            return entry
+        self._metrics.record_lookups(0, 1)
+        return None
+
+    async def get_many(self, symbols: Iterable[str], date=None) -> Dict[str, Optional[dict]]:
+        """
+        Bulk lookup under a single lock acquisition. Symbols not in the cache map to None.
+        date defaults to the current trading day; past days are served from the local store.
+        """
+        await self._warm_up.wait_ready()
+        date = _to_date_str(date if date else APP.conf.last_trading_day)
+        async with self._metrics.locked(self._cache_lock):
+            day = await self._ensure_day_loaded(date)
+            entries = {symbol: day.get(symbol) for symbol in symbols}
+        hits = sum(entry is not None for entry in entries.values())
+        self._metrics.record_lookups(hits, len(entries) - hits)
+        return entries
+
+    async def get_ib_history(self, symbols: List[str], dates: List[str]) -> Dict[str, Dict[str, float]]:
+        """
+        Return the cached ADJUSTED_LAST bars of each symbol over the given trading days as
+        { symbol: { date: close } }. Days not in memory are read from the store.
+        """
+        await self._warm_up.wait_ready()
+        history = {symbol: {} for symbol in symbols}
+        async with self._metrics.locked(self._cache_lock):
+            for date in dates:
+                day = await self._ensure_day_loaded(_to_date_str(date))
+                for symbol, close in zip(symbols, day.values('ib_bar_close', symbols).tolist()):
+                    if not math.isnan(close):
+                        history[symbol][day.date] = close
+        return history
+
+    async def set_ib_history(self, history: Mapping[str, Mapping[str, float]], snapshot_symbols: Iterable[str] = ()):
+        """
+        Store IB closes given as { symbol: { date: close } }, one batch per trading day. Bars go to each day's
+        ib_bar_close; only the current trading day also takes the close as its ib_close, marked as a snapshot
+        close for snapshot_symbols. A past day's ib_close is left as it was reconciled.
+        """
+        trading_day = _to_date_str(APP.conf.last_trading_day)
+        snapshot_symbols = set(snapshot_symbols)
+        by_date: Dict[str, Dict[str, Dict[str, Optional[float]]]] = {}
+        for symbol, closes in history.items():
+            for date, close in closes.items():
+                date = _to_date_str(date)
+                updates = by_date.setdefault(date, {})
+                if symbol not in snapshot_symbols:
+                    updates.setdefault('ib_bar_close', {})[symbol] = close
+                if date == trading_day:
+                    updates.setdefault('ib_close', {})[symbol] = close
+                    updates.setdefault('ib_snapshot', {})[symbol] = 1.0 if symbol in snapshot_symbols else None
+        for date, updates in sorted(by_date.items()):
+            await self._set_many(updates, date)
+
+    async def get_table(self, date=None) -> PriceTable:
+        """
+        Return a snapshot of a trading day's columnar price table.
+        """
+        await self._warm_up.wait_ready()
+        date = _to_date_str(date if date else APP.conf.last_trading_day)
+        async with self._metrics.locked(self._cache_lock):
+            day = await self._ensure_day_loaded(date)
+            return day.copy()
+
+    async def get_day(self, date=None) -> pd.DataFrame:
+        """
+        Return a trading day's reconciliation data as a DataFrame (symbol, ib_close, refinitiv_close, ib_snapshot,
+        ib_bar_close).
+        Days not in memory are read from the store in one call.
+        """
+        await self._warm_up.wait_ready()
+        date = _to_date_str(date if date else APP.conf.last_trading_day)
+        async with self._metrics.locked(self._cache_lock):
+            day = self._days.get(date)
+            if day is None:
+                return await asyncio.to_thread(self._store.load_day, date)
+            return day.to_frame()
+
+    async def find_discrepancies(self, symbols: List[str], date=None, abs_tolerance: float = None,
+                                 rel_tolerance: float = None) -> pd.DataFrame:
+        """
+        Return the symbols whose IB and Refinitiv closes are missing or differ by more than
+        abs_tolerance + rel_tolerance * |refinitiv_close|, with both prices.
+        """
+        await self._warm_up.wait_ready()
+        date = _to_date_str(date if date else APP.conf.last_trading_day)
+        abs_tolerance = APP.conf.price_abs_tolerance if abs_tolerance is None else abs_tolerance
+        rel_tolerance = APP.conf.price_rel_tolerance if rel_tolerance is None else rel_tolerance
+        async with self._metrics.locked(self._cache_lock):
+            day = await self._ensure_day_loaded(date)
+            flagged = day.discrepancies(symbols, abs_tolerance, rel_tolerance)
+            flagged_symbols = [symbol for symbol, is_flagged in zip(symbols, flagged) if is_flagged]
+            return pd.DataFrame({
+                'symbol': flagged_symbols,
+                'ib_close': day.values('ib_close', flagged_symbols),
+                'refinitiv_close': day.values('refinitiv_close', flagged_symbols),
+            })
+
+    async def available_dates(self) -> List[str]:
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            stored = await asyncio.to_thread(self._store.dates)
+            return sorted(set(stored) | {day for day, table in self._days.items() if len(table)})
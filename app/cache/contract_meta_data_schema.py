@@ -49,5 +49,7 @@ FIELDNAMES = [
     'isin',
     'ib_currency',
     'created_time',
-    'update_time'
+    'update_time',
+    'refinitiv_update_time',
+    'ib_update_time'
 ]
\ No newline at end of file
@@ -2,21 +2,39 @@ import asyncio
 import csv
 import logging
 import os
-from datetime import datetime
-from typing import Dict, Optional, List
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Optional, List, Set
 
+from app.cache.cache_metrics import CacheMetrics
 from app.cache.contract_meta_data_schema import FIELDNAMES
+from app.cache.contract_record import ContractRecord
+from app.cache.warm_up import CacheWarmUp
+from app.cache.write_behind import WriteBehindBuffer
+from app.config import APP
 
 
 class ContractMetadataCache:
+    """
+    Contract metadata keyed by symbol, persisted to an append-only CSV file. The tracked contract_metadata.csv
+    only seeds that file on first start: it is read and migrated in memory, never written.
+    """
     _instance = None
-    _csv_path = os.path.join(os.path.dirname(__file__), "storage", "contract_metadata.csv")
+    _csv_path = os.path.join(os.path.dirname(__file__), "storage", "contract_metadata_db.csv")
+    _legacy_csv_path = os.path.join(os.path.dirname(__file__), "storage", "contract_metadata.csv")
 
     def __init__(self):
-        self._cache: Dict[str, Dict[str, str]] = {}
+        self._cache: Dict[str, ContractRecord] = {}
         self._cache_lock = asyncio.Lock()
-        self._initialize_csv()
-        self._load_from_csv()
+        self._row_count = 0  # rows in the CSV file, including superseded ones
+        self._metrics = CacheMetrics.for_cache("contract_metadata")
+        self._writer = WriteBehindBuffer(
+            "contract metadata",
+            self._flush,
+            flush_interval=APP.conf.metadata_flush_interval_sec,
+            max_pending=APP.conf.metadata_flush_max_pending,
+        )
+        self._warm_up = CacheWarmUp("Contract Metadata Cache", self._load)
 
     @classmethod
     def instance(cls):
@@ -24,6 +42,35 @@ class ContractMetadataCache:
             cls._instance = cls()
         return cls._instance
 
+    @property
+    def warm_up(self) -> CacheWarmUp:
+        return self._warm_up
+
+    @property
+    def metrics(self) -> CacheMetrics:
+        return self._metrics
+
+    def _load(self):
+        if not os.path.exists(self._csv_path) and os.path.exists(self._legacy_csv_path):
+            self._import_legacy_csv()
+            return
+        self._initialize_csv()
+        schema_changed = self._load_from_csv(self._csv_path)
+        if schema_changed is None:
+            return
+        seeded = self._seed_update_times()
+
+        # appended rows follow FIELDNAMES, so a file written with an older header is rewritten first
+        if schema_changed or seeded or self._needs_compaction():
+            self._write_csv([record.to_values() for record in self._cache.values()])
+
+    def _import_legacy_csv(self):
+        if self._load_from_csv(self._legacy_csv_path) is None:
+            return
+        self._seed_update_times()
+        self._write_csv([record.to_values() for record in self._cache.values()])
+        logging.info(f"Imported {len(self._cache)} records from {self._legacy_csv_path}")
+
     def _initialize_csv(self):
         if not os.path.exists(self._csv_path):
             os.makedirs(os.path.dirname(self._csv_path), exist_ok=True)
@@ -32,59 +79,189 @@ class ContractMetadataCache:
                 writer.writeheader()
             logging.info(f"Created metadata db in {self._csv_path}")
 
-    def _load_from_csv(self):
+    def _load_from_csv(self, path: str) -> Optional[bool]:
+        """
+        Load the records of a CSV file and return whether its header differs from FIELDNAMES, or None when
+        the file could not be read.
+        """
         try:
-            with open(self._csv_path, mode='r', newline='', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    symbol = row['symbol']
-                    self._cache[symbol] = row
+            # the file is append-only between compactions, so a later row for a symbol replaces an earlier one
+            with open(path, mode='r', newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                header = next(reader, FIELDNAMES)
+                schema_changed = header != FIELDNAMES
+                for values in reader:
+                    record = ContractRecord.from_values(header, values)
+                    self._cache[record.symbol] = record
+                    self._row_count += 1
             if self._cache:
                 logging.info(f"Loaded {len(self._cache)} records into contract metadata cache")
         except Exception as e:
             logging.error(f"Error loading from CSV file: {e}")
+            return None
+        return schema_changed
 
-    def _save_to_csv(self):
-        try:
-            with open(self._csv_path, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.DictWriter(file, fieldnames=FIELDNAMES)
-                writer.writeheader()
-                for record in self._cache.values():
-                    writer.writerow(record)
-            logging.info(f"Saved {len(self._cache)} records to CSV file")
-        except Exception as e:
-            logging.error(f"Error saving to CSV file: {e}")
+    def _seed_update_times(self) -> int:
+        """
+        Give records written before per-source update times existed one spread uniformly over the source's TTL,
+        so they go stale a few at a time instead of all on the first refresh.
+        """
+        now = datetime.utcnow()
+        seeded = 0
+        for record in self._cache.values():
+            for source, value, ttl_hours in (('refinitiv', record['refinitiv_ric'], APP.conf.metadata_ric_ttl_hours),
+                                             ('ib', record['ib_conid'], APP.conf.metadata_ib_ttl_hours)):
+                if value and not record[f'{source}_update_time']:
+                    age = timedelta(hours=ttl_hours * random.random())
+                    record[f'{source}_update_time'] = (now - age).isoformat()
+                    seeded += 1
+        if seeded:
+            logging.info(f"Seeded {seeded} per-source update times of contract metadata")
+        return seeded
+
+    def _needs_compaction(self) -> bool:
+        superseded = self._row_count - len(self._cache)
+        return superseded > max(APP.conf.metadata_compaction_min_rows, len(self._cache))
+
+    def _append_to_csv(self, records: List[List[str]]):
+        with self._metrics.timed('persist'), open(self._csv_path, mode='a', newline='', encoding='utf-8') as file:
+            start = file.tell()
+            writer = csv.writer(file)
+            writer.writerows(records)
+            file.flush()
+            os.fsync(file.fileno())
+            self._metrics.inc('bytes_persisted', file.tell() - start)
+        self._metrics.inc('rows_persisted', len(records))
+        logging.info(f"Appended {len(records)} records to CSV file")
+
+    def _write_csv(self, records: List[List[str]]):
+        tmp_path = f"{self._csv_path}.tmp"
+        with self._metrics.timed('compaction'), open(tmp_path, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(FIELDNAMES)
+            writer.writerows(records)
+            file.flush()
+            os.fsync(file.fileno())
+            self._metrics.inc('bytes_persisted', file.tell())
+        os.replace(tmp_path, self._csv_path)
+        self._metrics.inc('compactions')
+        self._row_count = len(records)
+        logging.info(f"Compacted CSV file to {len(records)} records")
+
+    async def _flush(self, symbols: Set[str]):
+        async with self._metrics.locked(self._cache_lock):
+            records = [self._cache[symbol].to_values() for symbol in symbols]
+        await asyncio.to_thread(self._append_to_csv, records)
+        self._row_count += len(records)
+
+        if self._needs_compaction():
+            async with self._metrics.locked(self._cache_lock):
+                snapshot = [record.to_values() for record in self._cache.values()]
+            await asyncio.to_thread(self._write_csv, snapshot)
+
+    async def flush(self):
+        await self._writer.flush()
+
+    async def close(self):
+        await self._writer.close()
 
     async def update_metadata(self, symbol: str, refinitiv_data: Optional[Dict[str, str]] = None, ib_data: Optional[Dict[str, str]] = None):
-        async with self._cache_lock:
-            now = datetime.utcnow().isoformat()
-            record = self._cache.get(symbol, {field: '' for field in FIELDNAMES})
-            record['symbol'] = symbol
-
-            if not record.get('created_time'):
-                record['created_time'] = now
-
-            if refinitiv_data:
-                record['refinitiv_title'] = refinitiv_data.get('title', '')
-                record['refinitiv_ric'] = refinitiv_data.get('ric', '')
-
-            if ib_data:
-                record['ib_conid'] = str(ib_data.get('conId', ''))
-                record['ib_primary_exchange'] = ib_data.get('primaryExchange', '')
-                record['ib_currency'] = ib_data.get('currency', '')
-                record['ib_long_name'] = ib_data.get('description', '')
-                record['ib_exchange'] = ib_data.get('exchange', '')
-                record['ib_price_magnifier'] = ib_data.get('multiplier', '')
-                record['ib_under_sec_type'] = ib_data.get('secType', '')
-            record['update_time'] = now
-            self._cache[symbol] = record
-            self._save_to_csv()
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            self._apply_update(symbol, refinitiv_data, ib_data, datetime.utcnow().isoformat())
             logging.info(f"Updated metadata for symbol: {symbol}")
 
-    async def get_metadata(self, symbol: str) -> Optional[Dict[str, str]]:
-        async with self._cache_lock:
-            return self._cache.get(symbol)
+    async def update_many(self, refinitiv_data: Optional[Dict[str, Dict[str, str]]] = None,
+                          ib_data: Optional[Dict[str, Dict[str, str]]] = None):
+        """
+        Apply per-symbol updates ({ symbol: data }) under a single lock acquisition; they are persisted
+        together by the next write-behind flush.
+        """
+        await self._warm_up.wait_ready()
+        refinitiv_data = refinitiv_data or {}
+        ib_data = ib_data or {}
+        symbols = list(dict.fromkeys([*refinitiv_data, *ib_data]))
+        if not symbols:
+            return
+        async with self._metrics.locked(self._cache_lock):
+            now = datetime.utcnow().isoformat()
+            for symbol in symbols:
+                self._apply_update(symbol, refinitiv_data.get(symbol), ib_data.get(symbol), now)
+        logging.info(f"Updated metadata for {len(symbols)} symbols")
+
+    def _apply_update(self, symbol: str, refinitiv_data: Optional[Dict[str, str]], ib_data: Optional[Dict[str, str]],
+                      now: str):
+        """
+        Must be called while holding _cache_lock.
+        """
+        record = self._cache.get(symbol) or ContractRecord(symbol)
+
+        if not record.get('created_time'):
+            record['created_time'] = now
+
+        if refinitiv_data:
+            record['refinitiv_title'] = refinitiv_data.get('title', '')
+            record['refinitiv_ric'] = refinitiv_data.get('ric', '')
+            record['refinitiv_update_time'] = now
+
+        if ib_data:
+            record['ib_conid'] = str(ib_data.get('conId', ''))
+            record['ib_primary_exchange'] = ib_data.get('primaryExchange', '')
+            record['ib_currency'] = ib_data.get('currency', '')
+            record['ib_long_name'] = ib_data.get('description', '')
+            record['ib_exchange'] = ib_data.get('exchange', '')
+            record['ib_price_magnifier'] = ib_data.get('multiplier', '')
+            record['ib_under_sec_type'] = ib_data.get('secType', '')
+            record['ib_update_time'] = now
+        record['update_time'] = now
+        self._cache[symbol] = record
+        self._writer.mark_dirty(symbol)
+        self._metrics.inc('writes')
+
+    async def get_metadata(self, symbol: str) -> Optional[ContractRecord]:
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            record = self._cache.get(symbol)
+        self._metrics.record_lookups(record is not None, record is None)
+        return record
+
+    async def get_many_metadata(self, symbols: List[str]) -> Dict[str, Optional[ContractRecord]]:
+        """
+        Bulk lookup under a single lock acquisition. Symbols not in the cache map to None.
+        """
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            records = {symbol: self._cache.get(symbol) for symbol in symbols}
+        hits = sum(record is not None for record in records.values())
+        self._metrics.record_lookups(hits, len(records) - hits)
+        return records
+
+    @staticmethod
+    def is_stale(record: ContractRecord, source: str, now: Optional[datetime] = None) -> bool:
+        """
+        True when the record's data for source ('refinitiv' or 'ib') is older than its TTL.
+        """
+        if source == 'refinitiv':
+            value, ttl_hours = record['refinitiv_ric'], APP.conf.metadata_ric_ttl_hours
+        else:
+            value, ttl_hours = record['ib_conid'], APP.conf.metadata_ib_ttl_hours
+        if not value:
+            return False
+        updated = record[f'{source}_update_time']
+        if not updated:
+            return True
+        now = now or datetime.utcnow()
+        return now - datetime.fromisoformat(updated) > timedelta(hours=ttl_hours)
+
+    async def get_stale_symbols(self, source: str) -> List[str]:
+        await self._warm_up.wait_ready()
+        now = datetime.utcnow()
+        async with self._metrics.locked(self._cache_lock):
+            stale = [symbol for symbol, record in self._cache.items() if self.is_stale(record, source, now)]
+        self._metrics.inc(f'{source}_expired', len(stale))
+        return stale
 
-    async def get_all_metadata(self) -> List[Dict[str, str]]:
-        async with self._cache_lock:
+    async def get_all_metadata(self) -> List[ContractRecord]:
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
             return list(self._cache.values())
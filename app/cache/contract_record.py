@@ -0,0 +1,101 @@
+import sys
+from typing import Dict, List, Optional
+
+from app.cache.contract_meta_data_schema import FIELDNAMES
+
+# fields written by ContractMetadataCache.update_metadata, kept in slots; the other IB fields are rarely set
+SLOT_FIELDS = (
+    'symbol',
+    'refinitiv_title',
+    'refinitiv_ric',
+    'ib_conid',
+    'ib_primary_exchange',
+    'ib_exchange',
+    'ib_long_name',
+    'ib_price_magnifier',
+    'ib_under_sec_type',
+    'ib_currency',
+    'created_time',
+    'update_time',
+    'refinitiv_update_time',
+    'ib_update_time',
+)
+
+# low-cardinality values shared by most records
+INTERNED_FIELDS = frozenset(('ib_primary_exchange', 'ib_exchange', 'ib_under_sec_type', 'ib_currency'))
+
+_SLOT_SET = frozenset(SLOT_FIELDS)
+_FIELD_SET = frozenset(FIELDNAMES)
+
+
+class ContractRecord:
+    """
+    Compact contract metadata entry. Frequently populated fields live in slots, the remaining
+    FIELDNAMES are stored sparsely and only when non-empty. Supports the dict-style access used by callers.
+    """
+    __slots__ = SLOT_FIELDS + ('_extra',)
+
+    def __init__(self, symbol: str = ''):
+        for field in SLOT_FIELDS:
+            setattr(self, field, '')
+        self.symbol = symbol
+        self._extra: Optional[Dict[str, str]] = None
+
+    @classmethod
+    def from_values(cls, header: List[str], values: List[str]) -> 'ContractRecord':
+        record = cls()
+        for field, value in zip(header, values):
+            if value and field in _FIELD_SET:
+                record[field] = value
+        return record
+
+    def to_values(self) -> List[str]:
+        """
+        Return the values ordered as FIELDNAMES, for CSV output.
+        """
+        return [self.get(field, '') for field in FIELDNAMES]
+
+    def to_dict(self) -> Dict[str, str]:
+        return dict(zip(FIELDNAMES, self.to_values()))
+
+    def copy(self) -> 'ContractRecord':
+        record = ContractRecord()
+        for field in SLOT_FIELDS:
+            setattr(record, field, getattr(self, field))
+        record._extra = dict(self._extra) if self._extra else None
+        return record
+
+    def __getitem__(self, field: str) -> str:
+        if field in _SLOT_SET:
+            return getattr(self, field)
+        if field not in _FIELD_SET:
+            raise KeyError(field)
+        return self._extra.get(field, '') if self._extra else ''
+
+    def __setitem__(self, field: str, value: str):
+        value = '' if value is None else str(value)
+        if field in INTERNED_FIELDS:
+            value = sys.intern(value)
+        if field in _SLOT_SET:
+            setattr(self, field, value)
+        elif field in _FIELD_SET:
+            if value:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[field] = value
+            elif self._extra:
+                self._extra.pop(field, None)
+        else:
+            raise KeyError(field)
+
+    def __contains__(self, field: str) -> bool:
+        return field in _FIELD_SET
+
+    def get(self, field: str, default=None):
+        if field not in _FIELD_SET:
+            return default
+        return self[field]
+
+    def __repr__(self):
+        populated = {field: value for field, value in zip(FIELDNAMES, self.to_values()) if value}
+        return f"ContractRecord({populated})"
@@ -0,0 +1,225 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from app.cache.cache_metrics import CacheMetrics
+from app.cache.warm_up import CacheWarmUp
+from app.cache.write_behind import WriteBehindBuffer
+from app.config import APP
+
+# statuses a resumed run does not fetch again; 'fetch_failed' symbols are retried
+FINAL_STATUSES = frozenset({'fetched', 'cached', 'resolution_failed'})
+# run ids name the checkpoint files
+RUN_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+class FetchRunStore:
+    """
+    Progress checkpoints of IB fetch runs, one JSON file per run id with the status of every symbol.
+    A run restarted after a crash, or retried by the caller with the same run id, only fetches the symbols
+    without a final status. Runs of another trading day start over. Only unfinished runs are kept in memory,
+    finished ones are read back from their file; files older than FETCH_RUN_RETENTION_DAYS are pruned every
+    FETCH_RUN_PRUNE_INTERVAL_MIN.
+    """
+    _instance = None
+    _dir_path = os.path.join(os.path.dirname(__file__), "storage", "fetch_runs")
+
+    def __init__(self):
+        self._runs: Dict[str, dict] = {}  # { run_id: run }, unfinished runs and finished ones not yet flushed
+        self._pruned_at = time.monotonic()
+        self._cache_lock = asyncio.Lock()
+        self._metrics = CacheMetrics.for_cache("fetch_runs")
+        # one pending run flushes right away, a flush in progress coalesces the checkpoints behind it
+        self._writer = WriteBehindBuffer(
+            "fetch runs",
+            self._flush,
+            flush_interval=APP.conf.fetch_run_flush_interval_sec,
+            max_pending=1,
+        )
+        self._warm_up = CacheWarmUp("Fetch Run Store", self._load_runs)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def warm_up(self) -> CacheWarmUp:
+        return self._warm_up
+
+    @property
+    def metrics(self) -> CacheMetrics:
+        return self._metrics
+
+    def _path(self, run_id: str) -> str:
+        return os.path.join(self._dir_path, f"{run_id}.json")
+
+    @staticmethod
+    def _retention_cutoff() -> datetime:
+        return datetime.utcnow() - timedelta(days=APP.conf.fetch_run_retention_days)
+
+    def _load_runs(self):
+        self._prune_files()
+        if not os.path.isdir(self._dir_path):
+            return
+        for filename in os.listdir(self._dir_path):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(self._dir_path, filename), mode='r', encoding='utf-8') as file:
+                run = json.load(file)
+            if not run['finished']:
+                self._runs[run['run_id']] = run
+        if self._runs:
+            logging.info(f"Loaded {len(self._runs)} unfinished fetch run checkpoints")
+
+    def _read_run(self, run_id: str) -> Optional[dict]:
+        path = self._path(run_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, mode='r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def _prune_files(self) -> int:
+        """
+        Delete run files last written before the retention cutoff.
+        """
+        if not os.path.isdir(self._dir_path):
+            return 0
+        cutoff = self._retention_cutoff().timestamp()
+        removed = 0
+        for filename in os.listdir(self._dir_path):
+            path = os.path.join(self._dir_path, filename)
+            if filename.endswith('.json') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        if removed:
+            logging.info(f"Pruned {removed} fetch run checkpoints")
+        return removed
+
+    def _write_runs(self, runs: List[dict]):
+        os.makedirs(self._dir_path, exist_ok=True)
+        for run in runs:
+            path = self._path(run['run_id'])
+            tmp_path = f"{path}.tmp"
+            with self._metrics.timed('persist'), open(tmp_path, mode='w', encoding='utf-8') as file:
+                json.dump(run, file)
+                self._metrics.inc('bytes_persisted', file.tell())
+            os.replace(tmp_path, path)
+
+    async def _flush(self, keys: Set[str]):
+        async with self._metrics.locked(self._cache_lock):
+            runs = [copy.deepcopy(self._runs[key]) for key in keys if key in self._runs]
+        await asyncio.to_thread(self._write_runs, runs)
+
+        async with self._metrics.locked(self._cache_lock):
+            # a finished run is read from its file from now on, unless it changed after the snapshot was taken
+            for run in runs:
+                current = self._runs.get(run['run_id'])
+                if current and current['finished'] and current['update_time'] == run['update_time']:
+                    del self._runs[run['run_id']]
+                    self._metrics.inc('evictions')
+
+        if time.monotonic() - self._pruned_at >= APP.conf.fetch_run_prune_interval_min * 60:
+            self._pruned_at = time.monotonic()
+            await asyncio.to_thread(self._prune_files)
+            cutoff = self._retention_cutoff().isoformat()
+            async with self._metrics.locked(self._cache_lock):
+                # runs interrupted and never resumed within the retention period are abandoned
+                for run_id in [run_id for run_id, run in self._runs.items() if run['update_time'] < cutoff]:
+                    del self._runs[run_id]
+
+    async def close(self):
+        await self._writer.close()
+
+    async def start_run(self, run_id: Optional[str], symbols: Optional[List[str]], trading_day: str) -> dict:
+        """
+        Return a copy of the run with its recorded statuses, creating it when run_id is None or unknown.
+        symbols replace the run's symbols; without them a known run keeps its own and an unknown one raises
+        LookupError.
+        """
+        if run_id and not RUN_ID_PATTERN.fullmatch(run_id):
+            raise ValueError(f"Invalid run id: {run_id!r}")
+        await self._warm_up.wait_ready()
+        now = datetime.utcnow().isoformat()
+        async with self._metrics.locked(self._cache_lock):
+            run = self._runs.get(run_id) if run_id else None
+            if run_id and run is None:
+                run = await asyncio.to_thread(self._read_run, run_id)
+                if run is not None:
+                    self._runs[run_id] = run
+            self._metrics.record_lookups(int(run is not None), int(run is None))
+            if run is None and not symbols:
+                raise LookupError(f"Unknown run id: {run_id!r}")
+            if run is None or run['trading_day'] != trading_day:
+                run = {
+                    'run_id': run_id if run_id else uuid.uuid4().hex,
+                    'trading_day': trading_day,
+                    'symbols': run['symbols'] if run else [],
+                    'statuses': {},
+                    'created_time': now,
+                    'update_time': now,
+                    'finished': False,
+                }
+                self._runs[run['run_id']] = run
+            if symbols:
+                run['symbols'] = list(dict.fromkeys(symbols))
+            run['finished'] = False
+            run['update_time'] = now
+            self._writer.mark_dirty(run['run_id'])
+            return copy.deepcopy(run)
+
+    async def record(self, run_id: str, statuses: Dict[str, str]):
+        """
+        Checkpoint the statuses of some of the run's symbols.
+        """
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            run = self._runs.get(run_id)
+            if run is None:
+                return
+            run['statuses'].update(statuses)
+            run['update_time'] = datetime.utcnow().isoformat()
+            self._writer.mark_dirty(run_id)
+            self._metrics.inc('writes', len(statuses))
+
+    async def finish(self, run_id: str):
+        await self._warm_up.wait_ready()
+        async with self._metrics.locked(self._cache_lock):
+            run = self._runs.get(run_id)
+            if run is None:
+                return
+            run['finished'] = True
+            run['update_time'] = datetime.utcnow().isoformat()
+            self._writer.mark_dirty(run_id)
+
+    async def get_run(self, run_id: str) -> Optional[dict]:
+        """
+        Return a summary of the run: its statuses and counts per status.
+        """
+        await self._warm_up.wait_ready()
+        if not RUN_ID_PATTERN.fullmatch(run_id):
+            return None
+        async with self._metrics.locked(self._cache_lock):
+            run = copy.deepcopy(self._runs.get(run_id))
+        if run is None:
+            run = await asyncio.to_thread(self._read_run, run_id)
+            if run is None:
+                return None
+        counts: Dict[str, int] = {}
+        for status in run['statuses'].values():
+            counts[status] = counts.get(status, 0) + 1
+        run['counts'] = counts
+        run['pending'] = self.unfinished(run, run['symbols'])
+        return run
+
+    @staticmethod
+    def unfinished(run: dict, symbols: Iterable[str]) -> List[str]:
+        return [symbol for symbol in symbols if run['statuses'].get(symbol) not in FINAL_STATUSES]
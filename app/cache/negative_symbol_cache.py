@@ -0,0 +1,145 @@
+import asyncio
+import csv
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app.cache.cache_metrics import CacheMetrics
+from app.cache.warm_up import CacheWarmUp
+from app.cache.write_behind import WriteBehindBuffer
+from app.config import APP
+
+FIELDNAMES = ['source', 'symbol', 'reason', 'created_time', 'expires_time']
+
+# reason codes
+IB_NO_CONTRACT = 'ib_no_contract'
+REFINITIV_NO_RIC = 'refinitiv_no_ric'
+
+
+class NegativeSymbolCache:
+    """
+    Symbols a source could not resolve, with a reason code and an expiry. Callers consult it before a
+    network lookup so known-bad symbols are skipped until their entry expires or is purged.
+    """
+    _instance = None
+    _csv_path = os.path.join(os.path.dirname(__file__), "storage", "negative_symbols.csv")
+
+    def __init__(self):
+        self._cache: Dict[Tuple[str, str], Dict[str, str]] = {}  # { (source, symbol): entry }
+        self._cache_lock = asyncio.Lock()
+        self._metrics = CacheMetrics.for_cache("negative_symbols")
+        self._writer = WriteBehindBuffer(
+            "negative symbols",
+            self._flush,
+            flush_interval=APP.conf.negative_cache_flush_interval_sec,
+            max_pending=APP.conf.negative_cache_flush_max_pending,
+        )
+        self._warm_up = CacheWarmUp("Negative Symbol Cache", self._load_from_csv)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def warm_up(self) -> CacheWarmUp:
+        return self._warm_up
+
+    @property
+    def metrics(self) -> CacheMetrics:
+        return self._metrics
+
+    def _load_from_csv(self):
+        if not os.path.exists(self._csv_path):
+            return
+        now = datetime.utcnow().isoformat()
+        with open(self._csv_path, mode='r', newline='', encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                if row['expires_time'] > now:
+                    self._cache[(row['source'], row['symbol'])] = row
+        if self._cache:
+            logging.info(f"Loaded {len(self._cache)} records into negative symbol cache")
+
+    def _write_csv(self, records: List[Dict[str, str]]):
+        os.makedirs(os.path.dirname(self._csv_path), exist_ok=True)
+        tmp_path = f"{self._csv_path}.tmp"
+        with self._metrics.timed('persist'), open(tmp_path, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(records)
+            self._metrics.inc('bytes_persisted', file.tell())
+        os.replace(tmp_path, self._csv_path)
+        logging.info(f"Saved {len(records)} negative symbol records")
+
+    async def _flush(self, keys: Set[str]):
+        # the set is small and entries get purged, so every flush rewrites the whole file
+        async with self._metrics.locked(self._cache_lock):
+            records = [dict(entry) for entry in self._cache.values()]
+        await asyncio.to_thread(self._write_csv, records)
+
+    async def close(self):
+        await self._writer.close()
+
+    def _is_live(self, entry: Dict[str, str], now: str) -> bool:
+        return entry['expires_time'] > now
+
+    async def add(self, source: str, symbols: Iterable[str], reason: str):
+        await self._warm_up.wait_ready()
+        now = datetime.utcnow()
+        expires = (now + timedelta(hours=APP.conf.negative_cache_ttl_hours)).isoformat()
+        async with self._metrics.locked(self._cache_lock):
+            for symbol in symbols:
+                self._cache[(source, symbol)] = {
+                    'source': source,
+                    'symbol': symbol,
+                    'reason': reason,
+                    'created_time': now.isoformat(),
+                    'expires_time': expires,
+                }
+                self._writer.mark_dirty(f"{source}:{symbol}")
+                self._metrics.inc('writes')
+                logging.info(f"Added {symbol} to negative cache for {source}: {reason}")
+
+    async def get_negative(self, source: str, symbols: Iterable[str]) -> Set[str]:
+        """
+        Return the subset of symbols with a live negative entry for source.
+        """
+        await self._warm_up.wait_ready()
+        now = datetime.utcnow().isoformat()
+        symbols = list(symbols)
+        async with self._metrics.locked(self._cache_lock):
+            negative = {symbol for symbol in symbols
+                        if (source, symbol) in self._cache and self._is_live(self._cache[(source, symbol)], now)}
+        self._metrics.record_lookups(len(negative), len(symbols) - len(negative))
+        return negative
+
+    async def is_negative(self, source: str, symbol: str) -> bool:
+        return symbol in await self.get_negative(source, [symbol])
+
+    async def list_entries(self, source: Optional[str] = None) -> List[Dict[str, str]]:
+        await self._warm_up.wait_ready()
+        now = datetime.utcnow().isoformat()
+        async with self._metrics.locked(self._cache_lock):
+            return [dict(entry) for (entry_source, _), entry in self._cache.items()
+                    if (source is None or entry_source == source) and self._is_live(entry, now)]
+
+    async def purge(self, source: Optional[str] = None, symbols: Optional[Iterable[str]] = None) -> int:
+        """
+        Remove entries matching source and/or symbols (all entries when both are None), plus any expired ones.
+        """
+        await self._warm_up.wait_ready()
+        symbols = set(symbols) if symbols is not None else None
+        now = datetime.utcnow().isoformat()
+        async with self._metrics.locked(self._cache_lock):
+            matched = [key for key, entry in self._cache.items()
+                       if (source is None or key[0] == source) and (symbols is None or key[1] in symbols)]
+            expired = [key for key, entry in self._cache.items() if not self._is_live(entry, now)]
+            self._metrics.inc('expired', len(set(expired) - set(matched)))
+            for key in set(matched) | set(expired):
+                del self._cache[key]
+                self._writer.mark_dirty(f"{key[0]}:{key[1]}")
+        if matched:
+            logging.info(f"Purged {len(matched)} entries from negative symbol cache")
+        return len(matched)
@@ -0,0 +1,157 @@
+from typing import Dict, Iterable, List, Mapping, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+# ib_snapshot is 1 when ib_close is an unadjusted market data snapshot close rather than an ADJUSTED_LAST bar.
+# ib_bar_close is the day's ADJUSTED_LAST bar as last fetched, re-adjusted with later corporate actions, while
+# ib_close keeps the value reconciled on that day
+FIELDS = ('ib_close', 'refinitiv_close', 'ib_snapshot', 'ib_bar_close')
+
+
+class PriceTable:
+    """
+    Columnar closing prices of one trading day: a symbol -> row index plus one float64 array per source.
+    Missing prices are NaN.
+    """
+
+    def __init__(self, date: str, capacity: int = 1024):
+        self.date = date
+        self._index: Dict[str, int] = {}
+        self._symbols: List[str] = []
+        self._columns: Dict[str, np.ndarray] = {field: np.full(capacity, np.nan) for field in FIELDS}
+
+    @classmethod
+    def from_frame(cls, date: str, day_df: pd.DataFrame) -> 'PriceTable':
+        """
+        Build a table from a store partition with a 'symbol' column and a column per field; a missing field
+        column, e.g. in a partition written before the field existed, is NaN.
+        """
+        day_df = day_df.drop_duplicates(subset='symbol', keep='last')
+        table = cls(date, capacity=max(1024, len(day_df)))
+        table._symbols = day_df['symbol'].tolist()
+        table._index = {symbol: row for row, symbol in enumerate(table._symbols)}
+        for field in FIELDS:
+            if field in day_df.columns:
+                table._columns[field][:len(day_df)] = day_df[field].to_numpy(dtype='float64', na_value=np.nan)
+        return table
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __contains__(self, symbol: str):
+        return symbol in self._index
+
+    @property
+    def index(self) -> Dict[str, int]:
+        return self._index
+
+    def column(self, field: str) -> np.ndarray:
+        """
+        Read-only view of a price column, aligned with the row index.
+        """
+        view = self._columns[field][:len(self._symbols)]
+        view.flags.writeable = False
+        return view
+
+    def copy(self) -> 'PriceTable':
+        table = PriceTable(self.date, capacity=max(1024, len(self._symbols)))
+        table._symbols = list(self._symbols)
+        table._index = dict(self._index)
+        for field in FIELDS:
+            table._columns[field][:len(self._symbols)] = self._columns[field][:len(self._symbols)]
+        return table
+
+    def _grow(self, size: int):
+        capacity = len(self._columns[FIELDS[0]])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for field in FIELDS:
+            column = np.full(capacity, np.nan)
+            column[:len(self._symbols)] = self._columns[field][:len(self._symbols)]
+            self._columns[field] = column
+
+    def rows(self, symbols: Iterable[str], add_missing: bool = False) -> np.ndarray:
+        """
+        Return the row of each symbol; unknown symbols are appended when add_missing is set, otherwise -1.
+        """
+        rows = []
+        for symbol in symbols:
+            row = self._index.get(symbol, -1)
+            if row < 0 and add_missing:
+                row = len(self._symbols)
+                self._grow(row + 1)
+                self._index[symbol] = row
+                self._symbols.append(symbol)
+            rows.append(row)
+        return np.asarray(rows, dtype=np.int64)
+
+    def values(self, field: str, symbols: Iterable[str]) -> np.ndarray:
+        """
+        Gather a price column for the given symbols; unknown symbols are NaN.
+        """
+        rows = self.rows(symbols)
+        values = np.full(len(rows), np.nan)
+        known = rows >= 0
+        values[known] = self._columns[field][rows[known]]
+        return values
+
+    def set_many(self, field: str, prices: Union[Mapping[str, float], pd.Series]) -> List[str]:
+        """
+        Write a batch of prices for one source and return the symbols whose value changed or that were added.
+        """
+        if isinstance(prices, pd.Series):
+            symbols = prices.index.tolist()
+            new_values = pd.to_numeric(prices, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        else:
+            symbols = list(prices.keys())
+            new_values = pd.to_numeric(pd.Series(list(prices.values()), dtype='object'),
+                                       errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        if not symbols:
+            return []
+
+        size_before = len(self._symbols)
+        rows = self.rows(symbols, add_missing=True)
+        column = self._columns[field]
+        old_values = column[rows]
+        changed = ~((old_values == new_values) | (np.isnan(old_values) & np.isnan(new_values))) | (rows >= size_before)
+        column[rows] = new_values
+        return [symbol for symbol, is_changed in zip(symbols, changed) if is_changed]
+
+    def get(self, symbol: str) -> Optional[dict]:
+        """
+        Return { "date", "ib_close", "refinitiv_close", "ib_snapshot", "ib_bar_close" } for a symbol; missing values
+        are left out.
+        """
+        row = self._index.get(symbol)
+        if row is None:
+            return None
+        entry = {'date': self.date}
+        for field in FIELDS:
+            value = self._columns[field][row]
+            if not np.isnan(value):
+                entry[field] = float(value)
+        return entry
+
+    def to_frame(self) -> pd.DataFrame:
+        size = len(self._symbols)
+        return pd.DataFrame({
+            'symbol': self._symbols,
+            'ib_close': self._columns['ib_close'][:size].copy(),
+            'refinitiv_close': self._columns['refinitiv_close'][:size].copy(),
+            'ib_snapshot': self._columns['ib_snapshot'][:size].copy(),
+            'ib_bar_close': self._columns['ib_bar_close'][:size].copy(),
+        })
+
+    def discrepancies(self, symbols: List[str], abs_tolerance: float, rel_tolerance: float) -> np.ndarray:
+        """
+        Boolean mask over symbols: True when a price is missing or |ib - refinitiv| > abs + rel * |refinitiv|.
+        """
+        ib_close = self.values('ib_close', symbols)
+        refinitiv_close = self.values('refinitiv_close', symbols)
+        with np.errstate(invalid='ignore'):
+            tolerance = abs_tolerance + rel_tolerance * np.abs(refinitiv_close)
+            mismatch = np.abs(ib_close - refinitiv_close) > tolerance
+        return np.isnan(ib_close) | np.isnan(refinitiv_close) | mismatch
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+
+class CacheWarmUp:
+    """
+    Runs a cache's blocking load function once in a worker thread. Cache operations await wait_ready(),
+    which starts the load on first use if it was not already started in the background.
+    """
+
+    def __init__(self, name: str, load_fn: Callable[[], object]):
+        self._name = name
+        self._load_fn = load_fn
+        self._task: Optional[asyncio.Task] = None
+        self._ready = False
+        self._error: Optional[BaseException] = None
+        self.load_seconds: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    @property
+    def state(self) -> str:
+        if self._ready:
+            return 'ready'
+        if self._error is not None:
+            return 'failed'
+        return 'warming_up' if self._task else 'cold'
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._error is not None:
+            self._error = None
+            self._task = asyncio.get_running_loop().create_task(self._load())
+        return self._task
+
+    async def _load(self):
+        t0 = time.monotonic()
+        try:
+            await asyncio.to_thread(self._load_fn)
+        except BaseException as e:
+            self._error = e
+            logging.exception(f"Failed to warm up {self._name}")
+            raise
+        self.load_seconds = time.monotonic() - t0
+        self._ready = True
+        logging.info(f"{self._name} is ready, loaded in {self.load_seconds:.2f} seconds")
+
+    async def wait_ready(self):
+        if not self._ready:
+            await asyncio.shield(self.start())
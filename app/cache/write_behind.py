@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Set
+
+
+class WriteBehindBuffer:
+    """
+    Collects dirty keys in memory and hands them to an async flush callback in batches,
+    either every flush_interval seconds or as soon as max_pending keys are dirty.
+    """
+
+    def __init__(self, name: str, flush_fn: Callable[[Set[str]], Awaitable[None]],
+                 flush_interval: float, max_pending: int):
+        self._name = name
+        self._flush_fn = flush_fn
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._dirty: Set[str] = set()
+        self._flush_lock = asyncio.Lock()
+        self._timer_task: Optional[asyncio.Task] = None
+        self._size_flush_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def mark_dirty(self, key: str):
+        self._dirty.add(key)
+        self._ensure_timer()
+        if len(self._dirty) >= self._max_pending and not (self._size_flush_task and not self._size_flush_task.done()):
+            self._size_flush_task = asyncio.get_running_loop().create_task(self._safe_flush())
+
+    def _ensure_timer(self):
+        if self._closed or (self._timer_task and not self._timer_task.done()):
+            return
+        self._timer_task = asyncio.get_running_loop().create_task(self._run_timer())
+
+    async def _run_timer(self):
+        while not self._closed:
+            await asyncio.sleep(self._flush_interval)
+            await self._safe_flush()
+
+    async def _safe_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"{self._name}: write-behind flush failed: {e}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, set()
+            try:
+                await self._flush_fn(batch)
+            except Exception:
+                # keep the records dirty so the next flush retries them
+                self._dirty |= batch
+                raise
+
+    async def close(self):
+        self._closed = True
+        if self._timer_task:
+            self._timer_task.cancel()
+            try:
+                await self._timer_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        logging.info(f"{self._name}: write-behind buffer closed")
@@ -17,19 +17,99 @@ class AppConfig:
         if not self.refinitiv_app_key or not self.refinitiv_username or not self.refinitiv_password:
             raise ValueError("Environment variables for Refinitiv credentials are not set properly.")
 
+        # Refinitiv session, opened once and kept open by RefinitivSessionManager
+        self.refinitiv_session_timeout_sec = float(os.getenv('REFINITIV_SESSION_TIMEOUT_SEC', 60))
+        self.refinitiv_session_renew_min = float(os.getenv('REFINITIV_SESSION_RENEW_MIN', 8 * 60))  # 0 disables renewal
+        # a renewed session's requests may run as long as the 300 seconds http.request-timeout
+        self.refinitiv_session_drain_timeout_sec = float(os.getenv('REFINITIV_SESSION_DRAIN_TIMEOUT_SEC', 300))
+        self.refinitiv_health_check_interval_sec = float(os.getenv('REFINITIV_HEALTH_CHECK_INTERVAL_SEC', 60))
+        self.refinitiv_reconnect_min_sec = float(os.getenv('REFINITIV_RECONNECT_MIN_SEC', 2))
+        self.refinitiv_reconnect_max_sec = float(os.getenv('REFINITIV_RECONNECT_MAX_SEC', 120))
+
+        # Refinitiv request scheduling, batch sizes are in cost units (a field per symbol costs 1, plus
+        # REFINITIV_COST_PER_FIELD_YEAR per year of a date range)
+        self.refinitiv_max_concurrent_requests = int(os.getenv('REFINITIV_MAX_CONCURRENT_REQUESTS', 4))
+        self.refinitiv_target_latency_sec = float(os.getenv('REFINITIV_TARGET_LATENCY_SEC', 15))
+        self.refinitiv_batch_cost_budget = float(os.getenv('REFINITIV_BATCH_COST_BUDGET', 600))
+        self.refinitiv_batch_cost_min = float(os.getenv('REFINITIV_BATCH_COST_MIN', 50))
+        self.refinitiv_batch_cost_max = float(os.getenv('REFINITIV_BATCH_COST_MAX', 6000))
+        self.refinitiv_max_batch_size = int(os.getenv('REFINITIV_MAX_BATCH_SIZE', 500))
+        self.refinitiv_cost_per_field_year = float(os.getenv('REFINITIV_COST_PER_FIELD_YEAR', 0.5))
+
+        # retries and circuit breakers of upstream calls, see app/retry_policy.py
+        self.retry_attempts = int(os.getenv('RETRY_ATTEMPTS', 3))
+        self.retry_base_delay_sec = float(os.getenv('RETRY_BASE_DELAY_SEC', 1))
+        self.retry_max_delay_sec = float(os.getenv('RETRY_MAX_DELAY_SEC', 30))
+        self.breaker_failure_threshold = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+        self.breaker_reset_timeout_sec = float(os.getenv('BREAKER_RESET_TIMEOUT_SEC', 60))
+
         # IB fetcher config
         self.ib_max_concurrent_requests = int(os.getenv('IB_MAX_CONCURRENT_REQUESTS', 20))
         self.ib_max_retries = int(os.getenv('IB_MAX_RETRIES', 2))
         self.ib_batch_size = int(os.getenv('IB_BATCH_SIZE', 100))
-        self.ib_jitter_range_ms = (
-            int(os.getenv('IB_JITTER_MIN_MS', 100)),
-            int(os.getenv('IB_JITTER_MAX_MS', 300))
-        )
-        self.ib_max_concurrent_batches = int(os.getenv('IB_MAX_CONCURRENT_BATCHES', 3))
+        # IB historical data pacing, per client id
+        self.ib_pacing_rate_per_sec = float(os.getenv('IB_PACING_RATE_PER_SEC', 20))
+        self.ib_pacing_burst = int(os.getenv('IB_PACING_BURST', 20))
+        self.ib_pacing_identical_interval_sec = float(os.getenv('IB_PACING_IDENTICAL_INTERVAL_SEC', 15))
+        self.ib_pacing_per_contract_max = int(os.getenv('IB_PACING_PER_CONTRACT_MAX', 5))
+        self.ib_pacing_per_contract_window_sec = float(os.getenv('IB_PACING_PER_CONTRACT_WINDOW_SEC', 2))
+        # IB enforces 60 requests per 10 minutes only for bars of 30 seconds or less, 0 disables the window
+        self.ib_pacing_window_max_requests = int(os.getenv('IB_PACING_WINDOW_MAX_REQUESTS', 0))
+        self.ib_pacing_window_sec = float(os.getenv('IB_PACING_WINDOW_SEC', 600))
+        self.ib_pacing_backoff_sec = float(os.getenv('IB_PACING_BACKOFF_SEC', 5))
+        self.ib_pacing_backoff_max_sec = float(os.getenv('IB_PACING_BACKOFF_MAX_SEC', 120))
         self.ib_host= os.getenv('IB_HOST', '127.0.0.1')
         self.ib_port = int(os.getenv('IB_PORT', 7497))
+        self.ib_pool_size = int(os.getenv('IB_POOL_SIZE', 1))
+        self.ib_bar_window_days = int(os.getenv('IB_BAR_WINDOW_DAYS', 5))
+        # 'historical' always requests ADJUSTED_LAST bars; 'auto' uses snapshots for symbols the caller knows have
+        # no same-day corporate action; 'snapshot' uses them for every symbol not known to have one
+        self.ib_close_mode = os.getenv('IB_CLOSE_MODE', 'auto')
+        self.ib_snapshot_batch_size = int(os.getenv('IB_SNAPSHOT_BATCH_SIZE', 50))
+        self.ib_snapshot_timeout_sec = float(os.getenv('IB_SNAPSHOT_TIMEOUT_SEC', 15))
+        self.ib_snapshot_delayed = os.getenv('IB_SNAPSHOT_DELAYED', 'false').lower() == 'true'
+        # snapshot pacing, per client id: API messages per second and concurrent market data lines
+        self.ib_message_rate_per_sec = float(os.getenv('IB_MESSAGE_RATE_PER_SEC', 45))
+        self.ib_market_data_lines = int(os.getenv('IB_MARKET_DATA_LINES', 100))
+        self.ib_client_id = int(os.getenv('IB_CLIENT_ID', 1))  # first id of the pool, 1 picks a random one
+        self.ib_connect_timeout_sec = float(os.getenv('IB_CONNECT_TIMEOUT_SEC', 10))
+        self.ib_acquire_timeout_sec = float(os.getenv('IB_ACQUIRE_TIMEOUT_SEC', 15))
+        self.ib_health_check_interval_sec = float(os.getenv('IB_HEALTH_CHECK_INTERVAL_SEC', 30))
+        self.ib_reconnect_min_sec = float(os.getenv('IB_RECONNECT_MIN_SEC', 1))
+        self.ib_reconnect_max_sec = float(os.getenv('IB_RECONNECT_MAX_SEC', 60))
+
+        # cache config
+        self.closing_price_store = os.getenv('CLOSING_PRICE_STORE', 'parquet')
+        self.closing_price_retention_days = int(os.getenv('CLOSING_PRICE_RETENTION_DAYS', 90))
+        self.price_abs_tolerance = float(os.getenv('PRICE_ABS_TOLERANCE', 0.05))
+        self.price_rel_tolerance = float(os.getenv('PRICE_REL_TOLERANCE', 0))
+        self.metadata_flush_interval_sec = float(os.getenv('METADATA_FLUSH_INTERVAL_SEC', 5))
+        self.metadata_flush_max_pending = int(os.getenv('METADATA_FLUSH_MAX_PENDING', 500))
+        self.metadata_compaction_min_rows = int(os.getenv('METADATA_COMPACTION_MIN_ROWS', 1000))
+        self.metadata_ric_ttl_hours = float(os.getenv('METADATA_RIC_TTL_HOURS', 7 * 24))
+        self.metadata_ib_ttl_hours = float(os.getenv('METADATA_IB_TTL_HOURS', 7 * 24))
+        self.negative_cache_ttl_hours = float(os.getenv('NEGATIVE_CACHE_TTL_HOURS', 24))
+        self.negative_cache_flush_interval_sec = float(os.getenv('NEGATIVE_CACHE_FLUSH_INTERVAL_SEC', 5))
+        self.negative_cache_flush_max_pending = int(os.getenv('NEGATIVE_CACHE_FLUSH_MAX_PENDING', 100))
+        self.fetch_run_retention_days = float(os.getenv('FETCH_RUN_RETENTION_DAYS', 7))
+        self.fetch_run_prune_interval_min = float(os.getenv('FETCH_RUN_PRUNE_INTERVAL_MIN', 60))
+        self.fetch_run_flush_interval_sec = float(os.getenv('FETCH_RUN_FLUSH_INTERVAL_SEC', 5))
+        self.metadata_refresh_enabled = os.getenv('METADATA_REFRESH_ENABLED', 'true').lower() == 'true'
+        self.metadata_refresh_interval_min = float(os.getenv('METADATA_REFRESH_INTERVAL_MIN', 60))
+        self.metadata_refresh_batch_size = int(os.getenv('METADATA_REFRESH_BATCH_SIZE', 100))
+
+        # computed on first use, so importing the config does not build the NYSE calendar
+        self._last_trading_day = None
+
+    @property
+    def last_trading_day(self):
+        if self._last_trading_day is None:
+            self._last_trading_day = get_previous_trading_day()
+        return self._last_trading_day
 
-        self.last_trading_day = get_previous_trading_day()
+    @last_trading_day.setter
+    def last_trading_day(self, value):
+        self._last_trading_day = value
 
 
 @dataclasses.dataclass
@@ -2,25 +2,45 @@ import json
 import logging
 from datetime import datetime
 
-import pandas as pd
+import orjson
 from aiohttp import web
 
+from app.cache.cache_metrics import CacheMetrics
 from app.cache.closing_prices_cache import ClosingPriceCache
+from app.cache.contract_metadata_cache import ContractMetadataCache
+from app.cache.fetch_run_store import FetchRunStore
+from app.cache.negative_symbol_cache import NegativeSymbolCache
 from app.config import APP
+from app.ib.ib_connection import IBConnectionManager
 from app.ib.ib_service import fetch_last_adj_price
 from app.refinitiv.refinitiv import fetch_holdings_for_symbol
 from app.refinitiv.refinitive_service import fetch_corporate_actions
+from app.refinitiv.request_scheduler import RefinitivRequestScheduler
+from app.refinitiv.session_manager import RefinitivSessionManager
+from app.retry_policy import CircuitBreaker
+
+
+def _json_response(data, status: int = 200) -> web.Response:
+    """
+    web.json_response encoded with orjson, which also takes the numpy values of DataFrame output as they are.
+    """
+    body = orjson.dumps(data, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return web.Response(body=body, status=status, content_type='application/json')
 
 
 async def fetch_ib_last_adj_price_handler(request):
     try:
         data = await request.json()
         symbols = data.get('symbols', [])
-        if not symbols:
+        run_id = data.get('run_id')
+        if not symbols and not run_id:
             return web.json_response({'error': 'No symbols provided'}, status=400)
 
-        res = await fetch_last_adj_price(APP.conf.ib_host, APP.conf.ib_port)
-        return web.json_response(res)
+        # the run id of an interrupted request resumes it, without symbols the run's own are used
+        if not symbols and await FetchRunStore.instance().get_run(run_id) is None:
+            return web.json_response({'error': 'Unknown run id'}, status=404)
+        res = await fetch_last_adj_price(symbols, run_id=run_id)
+        return _json_response(res)
     except Exception as e:
         logging.exception("Unhandled error in fetch_ib_last_adj_price_handler")
         return web.json_response({'error': str(e)}, status=500)
@@ -34,7 +54,7 @@ async def fetch_refinitiv_corporate_actions_handler(request: web.Request):
             raise ValueError("Unable to validate corporate actions without symbols")
 
         response = await fetch_corporate_actions(symbols)
-        return web.json_response(response)
+        return _json_response(response)
 
     except Exception as e:
         logging.exception("Unhandled error in fetch_refinitiv_corporate_actions_handler")
@@ -52,45 +72,66 @@ async def filter_daily_corporate_action_handler(request):
         # ib_task = asyncio.create_task(fetch_last_adj_price(symbols))
         # refinitiv_task = asyncio.create_task(fetch_corporate_actions(symbols))
         # ib_results, refinitiv_results = await asyncio.gather(ib_task, refinitiv_task)
-        ib_results = await fetch_last_adj_price(symbols)
+        # corporate actions first, so IB can take snapshot closes for the symbols without one
         refinitiv_results = await fetch_corporate_actions(symbols)
+        adjusted_symbols = {action['Instrument'] for action in refinitiv_results.get('corporate_actions', [])}
+        adjusted_symbols.update(refinitiv_results.get('flagged_symbols', []))
+        ib_results = await fetch_last_adj_price(symbols, sorted(adjusted_symbols))
 
         if not ib_results.get("success"):
-            return web.json_response(ib_results, status=500)
+            return _json_response(ib_results, status=500)
 
         flagged_set = set(ib_results.get("fetch_failed", [])) | set(refinitiv_results.get("flagged_symbols", []))
 
         cache = ClosingPriceCache.instance()
-        for symbol in symbols:
-            data = await cache.get_prices(symbol)
-            ib_close = data.get("ib_close") if data else None
-            ref_close = data.get("refinitiv_close") if data else None
-            if ib_close is None or ref_close is None or \
-                pd.isna(ib_close) or pd.isna(ref_close) or \
-                ib_close == "" or ref_close == "" or \
-                abs(ib_close - ref_close) > 0.05:
-                logging.warning(f"{symbol} is flagged: ib_close={ib_close} vs. refinitiv_close={ref_close}")
-                flagged_set.add(symbol)
-
-        # TODO: make this generic function
-        def normalize_corporate_actions(data):
-            for entry in data:
-                for key, value in entry.items():
-                    if isinstance(value, pd.Timestamp):
-                        entry[key] = value.isoformat()
-            return data
-
-        normalized_actions = normalize_corporate_actions(refinitiv_results.get('corporate_actions', []))
+        discrepancies = await cache.find_discrepancies(symbols)
+        for symbol, ib_close, ref_close in discrepancies.itertuples(index=False):
+            logging.warning(f"{symbol} is flagged: ib_close={ib_close} vs. refinitiv_close={ref_close}")
+        flagged_set.update(discrepancies['symbol'])
 
-        return web.json_response({
+        # corporate action records come JSON-ready, dates as ISO strings
+        return _json_response({
             'flagged_symbols': sorted(flagged_set),
-            'corporate_actions': normalized_actions
+            'corporate_actions': refinitiv_results.get('corporate_actions', [])
         })
     except Exception as e:
         logging.exception("Unhandled error in filter_daily_corporate_action_handler")
         return web.json_response({'error': str(e)}, status=500)
 
 
+async def fetch_run_handler(request: web.Request):
+    try:
+        run = await FetchRunStore.instance().get_run(request.match_info['run_id'])
+        if run is None:
+            return web.json_response({'error': 'Unknown run id'}, status=404)
+        return web.json_response(run)
+    except Exception as e:
+        logging.exception("Unhandled error in fetch_run_handler")
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def list_negative_cache_handler(request: web.Request):
+    try:
+        source = request.query.get('source')
+        entries = await NegativeSymbolCache.instance().list_entries(source)
+        return web.json_response({'count': len(entries), 'entries': entries})
+    except Exception as e:
+        logging.exception("Unhandled error in list_negative_cache_handler")
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def purge_negative_cache_handler(request: web.Request):
+    try:
+        source = request.query.get('source')
+        symbols = request.query.get('symbols')
+        symbols = [symbol.strip() for symbol in symbols.split(',') if symbol.strip()] if symbols else None
+        purged = await NegativeSymbolCache.instance().purge(source, symbols)
+        return web.json_response({'purged': purged})
+    except Exception as e:
+        logging.exception("Unhandled error in purge_negative_cache_handler")
+        return web.json_response({'error': str(e)}, status=500)
+
+
 async def get_holdings(request: web.Request):
     try:
         index = 'QQQ'
@@ -105,12 +146,45 @@ async def get_holdings(request: web.Request):
         return web.json_response({'error': error_message}, status=404)
 
 
+def _cache_states() -> dict:
+    return {
+        'closing_prices': ClosingPriceCache.instance().warm_up.state,
+        'contract_metadata': ContractMetadataCache.instance().warm_up.state,
+        'negative_symbols': NegativeSymbolCache.instance().warm_up.state,
+        'fetch_runs': FetchRunStore.instance().warm_up.state,
+    }
+
+
 def health_check(request: web.Request):
+    caches = _cache_states()
+    ready = all(state == 'ready' for state in caches.values())
     message = {
         'current_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'last_trading_day': APP.conf.last_trading_day.strftime('%Y-%m-%d'),
-        'health_check': 'healthy'
+        'last_trading_day': APP.conf.last_trading_day.strftime('%Y-%m-%d') if ready else None,
+        'health_check': 'healthy',
+        'liveness': 'alive',
+        'readiness': 'ready' if ready else 'not_ready',
+        'caches': caches,
+        'ib_connection': IBConnectionManager.instance().state,
+        'ib_connections': IBConnectionManager.instance().connection_states(),
+        'refinitiv_session': RefinitivSessionManager.instance().state,
+        'circuit_breakers': CircuitBreaker.states(),
+        'refinitiv_scheduler': RefinitivRequestScheduler.instance().stats(),
     }
     serialized = json.dumps(message, default=str)
     response = web.json_response(serialized)
     return response
+
+
+def cache_metrics_handler(request: web.Request):
+    return web.json_response({
+        'current_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'caches': CacheMetrics.snapshot_all(),
+    })
+
+
+def readiness_check(request: web.Request):
+    caches = _cache_states()
+    ready = all(state == 'ready' for state in caches.values())
+    return web.json_response({'readiness': 'ready' if ready else 'not_ready', 'caches': caches},
+                             status=200 if ready else 503)
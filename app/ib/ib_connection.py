@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import random
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from app.config import APP
+from app.ib.ibclient import IBClient
+
+logger = logging.getLogger(__name__)
+
+
+class IBConnection:
+    """
+    One IB API connection with its own client id. A supervisor task keeps it connected, probes it periodically
+    and reconnects with exponential backoff when it drops. ib_insync multiplexes concurrent requests over the
+    socket by request id. Historical requests are paced by the client's PacingLimiter; request_slots, shared
+    with the client, caps other requests in flight on this connection across every lease, such as contract
+    lookups.
+    """
+
+    def __init__(self, client_id: int):
+        self.request_slots = asyncio.Semaphore(APP.conf.ib_max_concurrent_requests)
+        self.client = IBClient(client_id=client_id, request_slots=self.request_slots)
+        self.in_flight = 0  # leased batches
+        self._connected = asyncio.Event()
+        self._reconnect_needed = asyncio.Event()
+        self._supervisor_task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def client_id(self) -> int:
+        return self.client.client_id
+
+    @property
+    def state(self) -> str:
+        if self._closed:
+            return 'closed'
+        if self.client.is_connected():
+            return 'connected'
+        return 'connecting' if self._supervisor_task else 'disconnected'
+
+    def is_connected(self) -> bool:
+        return not self._closed and self.client.is_connected()
+
+    def start(self):
+        if self._supervisor_task is None:
+            self._supervisor_task = asyncio.get_running_loop().create_task(self._supervise())
+
+    async def close(self):
+        self._closed = True
+        if self._supervisor_task:
+            self._supervisor_task.cancel()
+            try:
+                await self._supervisor_task
+            except asyncio.CancelledError:
+                pass
+        self._connected.clear()
+        await self.client.disconnect()
+
+    async def wait_connected(self):
+        if not self.client.is_connected():
+            self._connected.clear()
+            self._reconnect_needed.set()
+        await self._connected.wait()
+
+    async def _supervise(self):
+        while not self._closed:
+            await self._connect_with_backoff()
+            await self._monitor()
+
+    async def _connect_with_backoff(self):
+        delay = APP.conf.ib_reconnect_min_sec
+        while not self._closed:
+            try:
+                await self.client.connect()
+                self.client.ib.disconnectedEvent += self._on_disconnected
+                self._connected.set()
+                self._reconnect_needed.clear()
+                self.last_error = None
+                return
+            except Exception as e:
+                self.last_error = str(e) or type(e).__name__
+                # jitter keeps several connections from reconnecting to TWS in lockstep
+                sleep_for = delay * random.uniform(0.8, 1.2)
+                logger.warning(f"IB connect failed for client id {self.client_id} ({self.last_error}), "
+                               f"retrying in {sleep_for:.1f} seconds")
+                await asyncio.sleep(sleep_for)
+                delay = min(delay * 2, APP.conf.ib_reconnect_max_sec)
+
+    async def _monitor(self):
+        """
+        Wait until the connection drops or stops answering a periodic probe.
+        """
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._reconnect_needed.wait(), APP.conf.ib_health_check_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            if not self._reconnect_needed.is_set() and await self._is_healthy():
+                continue
+
+            logger.warning(f"IB connection for client id {self.client_id} lost, reconnecting")
+            self._connected.clear()
+            self.client.ib.disconnectedEvent -= self._on_disconnected
+            await self.client.disconnect()
+            self.reconnects += 1
+            return
+
+    async def _is_healthy(self) -> bool:
+        if not self.client.is_connected():
+            return False
+        try:
+            await asyncio.wait_for(self.client.ib.reqCurrentTimeAsync(), APP.conf.ib_connect_timeout_sec)
+            return True
+        except Exception as e:
+            self.last_error = f"health check failed: {e or type(e).__name__}"
+            return False
+
+    def _on_disconnected(self):
+        self._connected.clear()
+        self._reconnect_needed.set()
+
+
+class IBConnectionManager:
+    """
+    App-scoped pool of IB_POOL_SIZE connections with consecutive client ids, so historical requests are spread
+    over several sockets and pacing budgets. Work is dispatched to the connected member with the fewest leases.
+    """
+    _instance = None
+
+    def __init__(self, size: int = None):
+        size = size if size else APP.conf.ib_pool_size
+        base_id = APP.conf.ib_client_id if APP.conf.ib_client_id != 1 else random.randint(1000, 999999 - size)
+        self._connections: List[IBConnection] = [IBConnection(base_id + i) for i in range(size)]
+        self._closed = False
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def size(self) -> int:
+        return len(self._connections)
+
+    @property
+    def state(self) -> str:
+        states = {connection.state for connection in self._connections}
+        if len(states) == 1:
+            return states.pop()
+        return 'degraded' if 'connected' in states else 'connecting'
+
+    def connection_states(self) -> List[dict]:
+        return [{
+            'client_id': connection.client_id,
+            'state': connection.state,
+            'in_flight': connection.in_flight,
+            'reconnects': connection.reconnects,
+            'last_error': connection.last_error,
+            'pacing': connection.client.pacing.stats(),
+            'market_data': connection.client.market_data.stats(),
+        } for connection in self._connections]
+
+    def start(self):
+        """
+        Start every connection's supervisor. They connect in the background, so startup does not wait for TWS.
+        """
+        for connection in self._connections:
+            connection.start()
+
+    async def close(self):
+        self._closed = True
+        await asyncio.gather(*[connection.close() for connection in self._connections])
+
+    async def _acquire(self, timeout: float = None) -> IBConnection:
+        if self._closed:
+            raise ConnectionError("IB connection manager is closed")
+        self.start()
+        timeout = APP.conf.ib_acquire_timeout_sec if timeout is None else timeout
+        connected = [connection for connection in self._connections if connection.is_connected()]
+        if not connected:
+            waiters = [asyncio.ensure_future(connection.wait_connected()) for connection in self._connections]
+            try:
+                await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+            connected = [connection for connection in self._connections if connection.is_connected()]
+            if not connected:
+                errors = {connection.last_error for connection in self._connections}
+                raise ConnectionError(f"IB is not connected after {timeout} seconds: {errors}")
+        return min(connected, key=lambda connection: connection.in_flight)
+
+    @asynccontextmanager
+    async def lease(self, timeout: float = None):
+        """
+        Lease the least-loaded connected connection for a unit of work, e.g. one batch of symbols.
+        """
+        connection = await self._acquire(timeout)
+        connection.in_flight += 1
+        try:
+            yield connection
+        finally:
+            connection.in_flight -= 1
@@ -1,56 +1,147 @@
 import asyncio
 import logging
-import random
-from typing import List, Dict
+import math
+from typing import Any, Hashable, Iterable, List, Dict, Optional, Set, Tuple
+
+from ib_insync import Contract
 
 from app.cache.closing_prices_cache import ClosingPriceCache
+from app.cache.contract_metadata_cache import ContractMetadataCache
+from app.cache.fetch_run_store import FINAL_STATUSES, FetchRunStore
+from app.cache.negative_symbol_cache import NegativeSymbolCache
 from app.config import APP
+from app.ib.ib_connection import IBConnectionManager
 from app.ib.ibclient import IBClient
+from app.single_flight import SingleFlight
+from app.utils import get_previous_trading_day, get_trading_days, is_after_market_close
 
 logger = logging.getLogger(__name__)
 
 
+class RetryQueue:
+    """
+    Work queue where a failed item is re-enqueued after its own backoff deadline (2 ** attempt seconds)
+    while other items keep flowing. join() returns once every submitted item has settled.
+    """
+
+    def __init__(self, max_retries: int):
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._attempts: Dict[Hashable, int] = {}
+        self._outstanding: Set[Hashable] = set()
+        self._timers: List[asyncio.TimerHandle] = []
+        self._sealed = False
+        self._settled = asyncio.Event()
+
+    def submit(self, key: Hashable, item: Any):
+        self._outstanding.add(key)
+        self._queue.put_nowait(item)
+
+    def hold(self, key: Hashable):
+        """
+        Mark key outstanding while it is handled outside the queue; it is settled or submitted later.
+        """
+        self._outstanding.add(key)
+
+    def retry(self, key: Hashable, item: Any) -> bool:
+        """
+        Schedule another attempt for key, or return False when its retries are used up.
+        """
+        attempt = self._attempts[key] = self._attempts.get(key, 0) + 1
+        if attempt > self.max_retries:
+            return False
+        self._outstanding.add(key)
+        delay = 2 ** attempt
+        logger.warning(f"{key} failed, retry {attempt}/{self.max_retries} in {delay} seconds")
+        self._timers.append(asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, item))
+        return True
+
+    def settle(self, key: Hashable):
+        self._outstanding.discard(key)
+        self._check_settled()
+
+    def seal(self):
+        """
+        No more items will be submitted; retries may still follow.
+        """
+        self._sealed = True
+        self._check_settled()
+
+    def _check_settled(self):
+        if self._sealed and not self._outstanding:
+            self._settled.set()
+
+    async def get(self) -> Any:
+        return await self._queue.get()
+
+    async def join(self):
+        await self._settled.wait()
+
+    def stop(self, workers: int):
+        """
+        Cancel pending retries and wake every worker with a None item.
+        """
+        for timer in self._timers:
+            timer.cancel()
+        for _ in range(workers):
+            self._queue.put_nowait(None)
+
+
 class IBPriceFetcher:
-    def __init__(self, ib_client: IBClient):
-        self.ib_client = ib_client
-        self.max_concurrent_requests = APP.conf.ib_max_concurrent_requests
+    def __init__(self, pool: IBConnectionManager):
+        self.pool = pool
         self.max_retries = APP.conf.ib_max_retries
         self.batch_size = APP.conf.ib_batch_size
-        self.jitter_range_ms = APP.conf.ib_jitter_range_ms
-        self.max_concurrent_batches = APP.conf.ib_max_concurrent_batches
         self.cache = ClosingPriceCache.instance()
+        self.metadata_cache = ContractMetadataCache.instance()
+        self.negative_cache = NegativeSymbolCache.instance()
+        self.single_flight = SingleFlight.instance()
+        self.runs = FetchRunStore.instance()
+        self.run_id: Optional[str] = None
         self.status_map: Dict[str, str] = {}
+        self.window: List[str] = []  # trading days of the bar window, oldest first
+        self.snapshot_symbols: Set[str] = set()  # symbols whose close is taken from a market data snapshot
+        self.snapshot_closes: Set[str] = set()  # snapshot symbols that got a close, stored marked as unadjusted
 
-    async def fetch_prices(self, symbols: List[str]):
+    async def fetch_prices(self, symbols: Optional[List[str]], adjusted_symbols: Optional[Iterable[str]] = None,
+                           run_id: Optional[str] = None):
+        """
+        adjusted_symbols are the symbols with a corporate action since the last trading day, e.g. from Refinitiv.
+        Their unadjusted snapshot close would differ from the ADJUSTED_LAST one, so they always use historical bars.
+        Progress is checkpointed under run_id (a new one when None). Passing the id of an interrupted run resumes
+        it: only symbols without a final status are fetched, and symbols may be omitted to reuse the run's own.
+        """
         try:
-            status_map: Dict[str, str] = {}
-            remaining_symbols = symbols.copy()
-
-            for attempt in range(1, self.max_retries + 2):
-                logger.info(f"Fetch attempt {attempt}, symbols left: {len(remaining_symbols)}")
-                failed: List[str] = []
-
-                batch_semaphore = asyncio.Semaphore(self.max_concurrent_batches)
-                tasks = []
+            trading_day = APP.conf.last_trading_day.strftime('%Y-%m-%d')
+            run = await self.runs.start_run(run_id, symbols, trading_day)
+            self.run_id = run['run_id']
+            symbols = run['symbols']
+            status_map: Dict[str, str] = {symbol: status for symbol, status in run['statuses'].items()
+                                          if status in FINAL_STATUSES}
+            pending = self.runs.unfinished(run, symbols)
+            if len(pending) < len(symbols):
+                logger.info(f"Resuming run {self.run_id}: {len(symbols) - len(pending)} of {len(symbols)} "
+                            f"symbols are already done")
 
-                for i in range(0, len(remaining_symbols), self.batch_size):
-                    batch = remaining_symbols[i:i + self.batch_size]
-                    tasks.append(self._process_batch_limited(batch, status_map, batch_semaphore))
+            self.window = await asyncio.to_thread(get_trading_days, APP.conf.last_trading_day,
+                                                  APP.conf.ib_bar_window_days)
+            self.snapshot_symbols = await asyncio.to_thread(self._snapshot_symbols, pending, adjusted_symbols)
 
-                await asyncio.gather(*tasks)
+            # request rate and concurrency are bounded by each connection's pacing limiter, and failed symbols
+            # are retried individually inside their batch, so there is no barrier between retry rounds
+            tasks = []
+            for i in range(0, len(pending), self.batch_size):
+                batch = pending[i:i + self.batch_size]
+                tasks.append(self._process_batch(batch, status_map))
 
-                failed = [s for s in remaining_symbols if status_map.get(s) not in ('fetched', 'resolution_failed')]
+            await asyncio.gather(*tasks)
+            await self.runs.finish(self.run_id)
 
-                if not failed:
-                    logger.info("All symbols fetched or definitively failed.")
-                    break
-                elif attempt <= self.max_retries:
-                    logger.warning(f"{len(failed)} symbols failed on attempt {attempt}, retrying...")
-                    await asyncio.sleep(2 ** attempt)
-                    remaining_symbols = failed
-                else:
-                    logger.error(f"Final attempt failed. Unresolved symbols: {failed}")
-                    break
+            failed = [s for s in symbols if status_map.get(s) not in FINAL_STATUSES]
+            if not failed:
+                logger.info("All symbols fetched or definitively failed.")
+            else:
+                logger.error(f"Unresolved symbols after {self.max_retries} retries: {failed}")
 
             # Finalize results
             self.status_map = status_map
@@ -63,47 +154,228 @@ class IBPriceFetcher:
             logger.info(f"  Successfully fetched: {len(fetched)}")
             logger.info(f"  Resolution failed: {len(resolution_failed)}")
             logger.info(f"  Fetch failed (e.g., timeout, data error): {len(fetch_failed)}")
-            return {"success": True, "resolution_failed": resolution_failed, "fetch_failed": fetch_failed}
+            return {"success": True, "run_id": self.run_id, "resolution_failed": resolution_failed,
+                    "fetch_failed": fetch_failed}
         except Exception as e:
             logger.exception(f"fetch_prices failed with error: {e}")
-            return {"success": False, "error": str(e)}
+            return {"success": False, "run_id": self.run_id, "error": str(e)}
+
+    @staticmethod
+    def _snapshot_symbols(symbols: List[str], adjusted_symbols: Optional[Iterable[str]]) -> Set[str]:
+        mode = APP.conf.ib_close_mode
+        if mode == 'historical' or (mode == 'auto' and adjusted_symbols is None):
+            return set()
+        # a snapshot's close is the previous session's, which is only the last trading day until today's close
+        if is_after_market_close() or get_previous_trading_day() != APP.conf.last_trading_day:
+            logger.info("Snapshot closes are past the last trading day, using historical bars for all symbols")
+            return set()
+        return set(symbols) - set(adjusted_symbols or [])
 
-    async def _process_batch_limited(self, symbols: List[str], status_map: Dict[str, str], semaphore: asyncio.Semaphore):
-        async with semaphore:
-            await self._process_batch(symbols, status_map)
+    async def _filter_cached(self, symbols: List[str], status_map: Dict[str, str], trading_day: str) -> List[str]:
+        """
+        Mark symbols with a cached close for trading_day as 'cached' and return the others.
+        """
+        cached_prices = await self.cache.get_many(symbols)
+
+        to_fetch = []
+        for symbol in symbols:
+            cached = cached_prices.get(symbol)
+            if cached and 'ib_close' in cached and cached['date'] == trading_day:
+                logger.info(f"{symbol} adjusted close already exists in cache for : {cached['date']}({cached['ib_close']})")
+                status_map[symbol] = 'cached'
+            else:
+                to_fetch.append(symbol)
+        return to_fetch
 
     async def _process_batch(self, symbols: List[str], status_map: Dict[str, str]) -> None:
-        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
-        tasks = [self._throttled_fetch(symbol, semaphore, status_map) for symbol in symbols]
-        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._fetch_batch(symbols, status_map)
+        # the batch's prices are stored by now, so a resumed run can skip the symbols recorded as done.
+        # An interrupted batch is not recorded; its stored prices make those symbols 'cached' on resume.
+        await self.runs.record(self.run_id, {symbol: status_map[symbol] for symbol in symbols
+                                             if symbol in status_map})
+
+    async def _fetch_batch(self, symbols: List[str], status_map: Dict[str, str]) -> None:
+        trading_day = APP.conf.last_trading_day.strftime('%Y-%m-%d')
+        to_fetch = await self._filter_cached(symbols, status_map, trading_day)
 
-    async def _throttled_fetch(self, symbol: str, semaphore: asyncio.Semaphore, status_map: Dict[str, str]):
-        async with semaphore:
+        # known-unresolvable symbols are skipped without a contract lookup; a cached contract always wins over
+        # a negative entry, e.g. one left by a failed metadata refresh
+        metadata = await self.metadata_cache.get_many_metadata(to_fetch)
+        unresolvable = await self.negative_cache.get_negative(
+            'ib', [symbol for symbol in to_fetch if not (metadata[symbol] and metadata[symbol].get('ib_conid'))])
+        if unresolvable:
+            logger.info(f"{len(unresolvable)} symbols are in the negative cache: {sorted(unresolvable)}")
+            for symbol in unresolvable:
+                status_map[symbol] = 'resolution_failed'
+            to_fetch = [symbol for symbol in to_fetch if symbol not in unresolvable]
+
+        if not to_fetch:
+            return
+
+        # symbols another request is already fetching for this trading day are awaited, not fetched again
+        keys = [('ib', symbol, trading_day) for symbol in to_fetch]
+        async with self.single_flight.flight(keys) as (owned, waiting):
+            # a flight that finished after the cache lookup above has already written its prices
+            owned_symbols = await self._filter_cached([symbol for _, symbol, _ in owned], status_map, trading_day)
+            if owned_symbols:
+                await self._fetch_owned(owned_symbols, status_map)
+            # owned keys are resolved before waiting, so two overlapping batches cannot wait on each other
+            for key in owned:
+                self.single_flight.resolve(key, status_map.get(key[1], 'fetch_failed'))
+            for (_, symbol, _), status in (await self.single_flight.wait(waiting)).items():
+                status_map[symbol] = status if isinstance(status, str) else 'fetch_failed'
+
+    async def _fetch_owned(self, symbols: List[str], status_map: Dict[str, str]):
+        # bars already cached in the window, so only the missing tail is requested. Snapshot closes are left out,
+        # the readjust check must compare ADJUSTED_LAST bars only
+        history = await self.cache.get_ib_history(symbols, self.window)
+        fetched_bars: Dict[str, Dict[str, float]] = {}
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with self.pool.lease() as connection:
+                        logger.info(f"Fetching {len(symbols)} symbols over IB client id {connection.client_id}")
+                        await self._run_pipeline(connection.client, symbols, status_map, history, fetched_bars)
+                    break
+                except ConnectionError as e:
+                    logger.error(f"No IB connection for a batch of {len(symbols)} symbols: {e}")
+                    for symbol in symbols:
+                        status_map[symbol] = 'fetch_failed'
+                    if attempt < self.max_retries:
+                        await asyncio.sleep(2 ** (attempt + 1))
+        finally:
+            # closes fetched before an interruption are kept, a resumed run finds them cached
+            if fetched_bars:
+                await self.cache.set_ib_history(fetched_bars, self.snapshot_closes.intersection(fetched_bars))
+
+    async def _run_pipeline(self, ib_client: IBClient, symbols: List[str], status_map: Dict[str, str],
+                            history: Dict[str, Dict[str, float]], fetched_bars: Dict[str, Dict[str, float]]):
+        """
+        Contract resolution feeds a queue consumed by the historical data workers, so contract lookups
+        overlap with bar requests instead of preceding each of them. Snapshot symbols are collected into
+        batched snapshot requests instead, and only the ones without a close are queued for bars.
+        """
+        queue = RetryQueue(self.max_retries)
+        worker_count = min(len(symbols), APP.conf.ib_max_concurrent_requests)
+        workers = [asyncio.create_task(self._fetch_worker(ib_client, queue, status_map, history, fetched_bars))
+                   for _ in range(worker_count)]
+        snapshot_batch: Dict[str, Contract] = {}
+        snapshot_batch_size = min(APP.conf.ib_snapshot_batch_size, ib_client.market_data.lines)
+        snapshot_tasks: List[asyncio.Task] = []
+
+        def flush_snapshots():
+            if snapshot_batch:
+                snapshot_tasks.append(asyncio.create_task(
+                    self._fetch_snapshots(ib_client, dict(snapshot_batch), queue, status_map, fetched_bars)))
+                snapshot_batch.clear()
+
+        try:
+            resolved = ib_client.resolve_contracts(symbols)
             try:
-                if self.jitter_range_ms:
-                    jitter = random.randint(*self.jitter_range_ms)
-                    await asyncio.sleep(jitter / 1000.0)
-
-                cached = await self.cache.get_prices(symbol)
-                if cached and cached['date'] == APP.conf.last_trading_day.strftime('%Y-%m-%d'):
-                    price = cached['ib_close']
-                    logger.info(f"{symbol} adjusted close already exists in cache for : {cached['date']}({price})")
-                    status_map[symbol] = 'cached'
-                else:
-                    price = await self.ib_client.fetch_adjusted_close(symbol)
-                    if price is not None:
-                        await self.cache.set_ib_close(symbol, price, APP.conf.last_trading_day)
-                        logger.info(f"Fetched from IB adjusted close for {symbol}: {price}")
-                        status_map[symbol] = 'fetched'
+                async for symbol, contract, error in resolved:
+                    if contract is not None and symbol in self.snapshot_symbols:
+                        queue.hold(symbol)
+                        snapshot_batch[symbol] = contract
+                        if len(snapshot_batch) >= snapshot_batch_size:
+                            flush_snapshots()
+                    elif contract is not None:
+                        queue.submit(symbol, (symbol, contract))
+                    elif error is not None:
+                        logger.error(f"{symbol} contract lookup failed: {error}")
+                        status_map[symbol] = 'fetch_failed'
+                        # the retry resolves the contract again before requesting bars
+                        queue.retry(symbol, (symbol, None))
                     else:
-                        raise ValueError("No price returned")
-            except ValueError as ve:
-                if "Could not resolve contract" in str(ve):
-                    logger.warning(f"{symbol} contract resolution failed: {ve}")
-                    status_map[symbol] = 'resolution_failed'
-                else:
-                    logger.error(f"{symbol} failed: {ve}")
-                    status_map[symbol] = 'fetch_failed'
-            except Exception as e:
-                logger.exception(f"{symbol} fetch exception: {e}")
+                        logger.warning(f"{symbol} contract resolution failed")
+                        status_map[symbol] = 'resolution_failed'
+            finally:
+                await resolved.aclose()
+            flush_snapshots()
+            queue.seal()
+            await queue.join()
+        finally:
+            for task in snapshot_tasks:
+                task.cancel()
+            queue.stop(len(workers))
+            await asyncio.gather(*snapshot_tasks, *workers, return_exceptions=True)
+
+    async def _fetch_snapshots(self, ib_client: IBClient, contracts: Dict[str, Contract], queue: RetryQueue,
+                               status_map: Dict[str, str], fetched_bars: Dict[str, Dict[str, float]]):
+        try:
+            closes = await ib_client.fetch_snapshot_closes(contracts)
+        except Exception as e:
+            logger.error(f"Snapshot request for {len(contracts)} symbols failed: {e}")
+            closes = {}
+
+        fallback = [symbol for symbol in contracts if closes.get(symbol) is None]
+        if fallback:
+            logger.info(f"No snapshot close for {len(fallback)} of {len(contracts)} symbols, using historical bars")
+        for symbol, contract in contracts.items():
+            close = closes.get(symbol)
+            if close is None:
+                queue.submit(symbol, (symbol, contract))
+                continue
+            fetched_bars[symbol] = {self.window[-1]: close}
+            self.snapshot_closes.add(symbol)
+            status_map[symbol] = 'fetched'
+            logger.info(f"Fetched from IB snapshot close for {symbol}: {close}")
+            queue.settle(symbol)
+
+    async def _fetch_worker(self, ib_client: IBClient, queue: RetryQueue, status_map: Dict[str, str],
+                            history: Dict[str, Dict[str, float]], fetched_bars: Dict[str, Dict[str, float]]):
+        while True:
+            item: Optional[Tuple[str, Optional[Contract]]] = await queue.get()
+            if item is None:
+                return
+            symbol, contract = item
+            await self._fetch_symbol(ib_client, symbol, status_map, history, fetched_bars, contract)
+            if status_map.get(symbol) == 'fetch_failed' and queue.retry(symbol, item):
+                continue
+            queue.settle(symbol)
+
+    def _tail_days(self, cached: Dict[str, float]) -> int:
+        """
+        Number of trading days to request: the days after the latest cached one, plus that day as an overlap
+        to detect re-adjusted history. Without cached bars the whole window is requested.
+        """
+        cached_days = [i for i, date in enumerate(self.window) if date in cached]
+        if not cached_days:
+            return len(self.window)
+        return len(self.window) - cached_days[-1]
+
+    @staticmethod
+    def _is_readjusted(cached: Dict[str, float], bars: Dict[str, float]) -> bool:
+        # a corporate action re-adjusts the whole ADJUSTED_LAST series, which shows on the overlapping day
+        return any(not math.isclose(bars[date], close, rel_tol=1e-9, abs_tol=1e-9)
+                   for date, close in cached.items() if date in bars)
+
+    async def _fetch_symbol(self, ib_client: IBClient, symbol: str, status_map: Dict[str, str],
+                            history: Dict[str, Dict[str, float]], fetched_bars: Dict[str, Dict[str, float]],
+                            contract: Optional[Contract] = None):
+        try:
+            cached = history.get(symbol, {})
+            duration_days = max(2, self._tail_days(cached))
+            bars = await ib_client.fetch_adjusted_bars(symbol, contract, duration_days)
+            if duration_days < len(self.window) and self._is_readjusted(cached, bars):
+                logger.info(f"{symbol} adjusted closes changed since they were cached, refetching {len(self.window)} days")
+                bars = await ib_client.fetch_adjusted_bars(symbol, contract, len(self.window))
+
+            window_bars = {date: close for date, close in bars.items() if date in self.window}
+            if window_bars:
+                fetched_bars[symbol] = window_bars
+            price = window_bars.get(self.window[-1])
+            if price is not None:
+                logger.info(f"Fetched from IB adjusted close for {symbol}: {price} ({len(window_bars)} bars)")
+                status_map[symbol] = 'fetched'
+            else:
+                raise ValueError("No price returned")
+        except ValueError as ve:
+            if "Could not resolve contract" in str(ve):
+                logger.warning(f"{symbol} contract resolution failed: {ve}")
+                status_map[symbol] = 'resolution_failed'
+            else:
+                logger.error(f"{symbol} failed: {ve}")
                 status_map[symbol] = 'fetch_failed'
+        except Exception as e:
+            logger.exception(f"{symbol} fetch exception: {e}")
+            status_map[symbol] = 'fetch_failed'
@@ -1,8 +1,7 @@
+from app.ib.ib_connection import IBConnectionManager
 from app.ib.ib_price_fetcher import IBPriceFetcher
-from app.ib.ibclient import IBClient
 
 
-async def fetch_last_adj_price(symbols: list[str]) -> dict:
-    async with IBClient() as ib_client:
-        fetcher = IBPriceFetcher(ib_client)
-        return await fetcher.fetch_prices(symbols)
\ No newline at end of file
+async def fetch_last_adj_price(symbols: list[str], adjusted_symbols: list[str] = None, run_id: str = None) -> dict:
+    fetcher = IBPriceFetcher(IBConnectionManager.instance())
+    return await fetcher.fetch_prices(symbols, adjusted_symbols, run_id)
@@ -1,39 +1,54 @@
+import asyncio
 import logging
 import random
-from typing import Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 from ib_insync import IB, Contract
 
 from app.cache.contract_metadata_cache import ContractMetadataCache
+from app.cache.negative_symbol_cache import NegativeSymbolCache, IB_NO_CONTRACT
 from app.config import APP
+from app.ib.pacing import MESSAGE_RATE_EXCEEDED_CODE, MarketDataLimiter, PacingLimiter, is_pacing_violation
 
 logger = logging.getLogger(__name__)
 
 
 class IBClient:
-    def __init__(self, host: str = None, port: int = None,  client_id=1):
+    def __init__(self, host: str = None, port: int = None,  client_id=1,
+                 request_slots: Optional[asyncio.Semaphore] = None):
         self.host = host if host else APP.conf.ib_host
         self.port = port if port else APP.conf.ib_port
         self.client_id = (
             random.randint(1000, 999999) if client_id == 1 else client_id
         )
         self.ib: Optional[IB] = None
-        self.cache: None
+        self.cache = ContractMetadataCache.instance()
+        self.pacing = PacingLimiter()
+        self.market_data = MarketDataLimiter()
+        # shared with the owning IBConnection, which caps non-historical requests on the socket with it
+        self.request_slots = request_slots if request_slots else asyncio.Semaphore(APP.conf.ib_max_concurrent_requests)
+        self._delayed_snapshots = 0  # snapshot requests in flight that need the delayed market data type
 
     async def __aenter__(self):
         await self.connect()
-        self.cache = ContractMetadataCache.instance()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.disconnect()
 
+    def is_connected(self) -> bool:
+        return self.ib is not None and self.ib.isConnected()
+
     async def connect(self):
         try:
-            if self.ib and self.ib.isConnected():
+            if self.is_connected():
                 return
-            self.ib = IB()
-            await self.ib.connectAsync(self.host, self.port, clientId=self.client_id, timeout=10)
+            # the IB object is reused across reconnects so event subscriptions stay attached
+            if self.ib is None:
+                self.ib = IB()
+                self.ib.errorEvent += self._on_error
+            await self.ib.connectAsync(self.host, self.port, clientId=self.client_id,
+                                       timeout=APP.conf.ib_connect_timeout_sec)
             if not self.ib.isConnected():
                 raise ConnectionError("Failed to connect to IB")
             logger.info("Connected to IB TWS")
@@ -41,70 +56,210 @@ class IBClient:
             logger.exception("Failed to connect to IB")
             raise e
 
+    def _on_error(self, req_id: int, error_code: int, error_string: str, contract: Optional[Contract]):
+        if is_pacing_violation(error_code, error_string):
+            self.pacing.report_violation()
+        elif error_code == MESSAGE_RATE_EXCEEDED_CODE:
+            self.market_data.report_violation()
+
     async def disconnect(self):
         try:
-            if self.ib and self.ib.isConnected():
+            if self.is_connected():
                 self.ib.disconnect()
                 logger.info("Disconnected from IB")
         except Exception as e:
             logger.warning(f"Error while disconnecting IB: {e}")
 
+    @staticmethod
+    def _contract_from_metadata(symbol: str, metadata) -> Contract:
+        contract = Contract()
+        contract.symbol = symbol
+        contract.secType = metadata.get('ib_under_sec_type')
+        contract.exchange = metadata.get('ib_exchange')
+        contract.currency = metadata.get('ib_currency')
+        contract.conId = int(metadata['ib_conid'])
+        contract.primaryExchange = metadata.get('ib_primary_exchange', '')
+        return contract
+
     async def resolve_contract(self, symbol: str) -> Optional[Contract]:
         metadata = await self.cache.get_metadata(symbol)
         if metadata and metadata.get('ib_conid'):
             logger.info(f"Loaded IB contract metadata for {symbol} from cache")
-            contract = Contract()
-            contract.symbol = symbol
-            contract.secType = metadata.get('ib_under_sec_type')
-            contract.exchange = metadata.get('ib_exchange')
-            contract.currency = metadata.get('ib_currency')
-            contract.conId = int(metadata['ib_conid'])
-            contract.primaryExchange = metadata.get('ib_primary_exchange', '')
-            return contract
+            return self._contract_from_metadata(symbol, metadata)
+
+        if await NegativeSymbolCache.instance().is_negative('ib', symbol):
+            logger.info(f"Skipping contract lookup for {symbol}, it is in the negative cache")
+            return None
 
+        return await self.request_contract(symbol)
 
+    async def resolve_contracts(self, symbols: List[str]) \
+            -> AsyncIterator[Tuple[str, Optional[Contract], Optional[Exception]]]:
+        """
+        Resolve many symbols, yielding (symbol, contract, error) as each one completes: cached contracts first,
+        then IB lookups, which run concurrently. contract is None for unresolvable symbols and for failed lookups
+        (error is set). Lookup results are written to the metadata and negative caches in one batch each.
+        """
+        metadata = await self.cache.get_many_metadata(symbols)
+        to_request = []
+        for symbol in symbols:
+            record = metadata.get(symbol)
+            if record and record.get('ib_conid'):
+                yield symbol, self._contract_from_metadata(symbol, record), None
+            else:
+                to_request.append(symbol)
+
+        unresolvable = await NegativeSymbolCache.instance().get_negative('ib', to_request)
+        for symbol in unresolvable:
+            yield symbol, None, None
+        to_request = [symbol for symbol in to_request if symbol not in unresolvable]
+        if not to_request:
+            return
+
+        logger.info(f"Resolving {len(to_request)} IB contracts")
+
+        async def lookup(symbol: str):
+            # every batch leasing this connection shares its request slots
+            async with self.request_slots:
+                try:
+                    return symbol, await self._request_details(symbol), None
+                except Exception as e:
+                    return symbol, None, e
+
+        resolved: Dict[str, Contract] = {}
+        missing: List[str] = []
+        lookups = [asyncio.ensure_future(lookup(symbol)) for symbol in to_request]
+        try:
+            for next_done in asyncio.as_completed(lookups):
+                symbol, contract, error = await next_done
+                if contract:
+                    resolved[symbol] = contract
+                elif error is None:
+                    missing.append(symbol)
+                yield symbol, contract, error
+        finally:
+            for pending in lookups:
+                pending.cancel()
+            if resolved:
+                await self.cache.update_many(ib_data={symbol: self._ib_data(contract)
+                                                      for symbol, contract in resolved.items()})
+            if missing:
+                await NegativeSymbolCache.instance().add('ib', missing, IB_NO_CONTRACT)
+
+    async def _request_details(self, symbol: str) -> Optional[Contract]:
         base = Contract(symbol=symbol, secType='STK', exchange='SMART', currency='USD')
         details = await self.ib.reqContractDetailsAsync(base)
         if details:
             contract = details[0].contract
             logger.info(f"Resolved {symbol} to conId: {contract.conId}")
+            return contract
+        logger.warning(f"Could not resolve contract for symbol: {symbol}")
+        return None
+
+    async def request_contract(self, symbol: str) -> Optional[Contract]:
+        """
+        Resolve a symbol with IB contract details, bypassing the cache, and store the result in the cache.
+        A symbol that is not found only goes to the negative cache when it has no cached contract, so a failed
+        refresh keeps the cached one usable.
+        """
+        contract = await self._request_details(symbol)
+        if contract:
             await self.update_cache(symbol, contract)
             return contract
-        else:
-            logger.warning(f"Could not resolve contract for symbol: {symbol}")
-            return None
+        metadata = await self.cache.get_metadata(symbol)
+        if not (metadata and metadata.get('ib_conid')):
+            await NegativeSymbolCache.instance().add('ib', [symbol], IB_NO_CONTRACT)
+        return None
 
-    async def fetch_adjusted_close(self, symbol: str) -> Optional[float]:
-        contract = await self.resolve_contract(symbol)
+    async def fetch_adjusted_bars(self, symbol: str, contract: Optional[Contract] = None,
+                                  duration_days: int = 2) -> Dict[str, float]:
+        """
+        Return the daily ADJUSTED_LAST closes of the last duration_days trading days as { 'YYYY-MM-DD': close }.
+        contract skips resolution when it was already resolved, e.g. by resolve_contracts.
+        """
+        contract = contract if contract else await self.resolve_contract(symbol)
         if not contract:
-            logger.warning(f"Could not resolve contract for symbol: {symbol}")
-            return None
+            raise ValueError(f"Could not resolve contract for symbol: {symbol}")
 
-        bars = await self.ib.reqHistoricalDataAsync(
-            contract,
-            endDateTime='',
-            durationStr='2 D',
-            barSizeSetting='1 day',
-            whatToShow='ADJUSTED_LAST',
-            useRTH=True,
-            formatDate=1
-        )
+        duration = f'{duration_days} D'
+        request_key = (contract.conId, '', duration, '1 day', 'ADJUSTED_LAST', True)
+        async with self.pacing.slot(request_key, (contract.conId, contract.exchange, 'ADJUSTED_LAST')):
+            bars = await self.ib.reqHistoricalDataAsync(
+                contract,
+                endDateTime='',
+                durationStr=duration,
+                barSizeSetting='1 day',
+                whatToShow='ADJUSTED_LAST',
+                useRTH=True,
+                formatDate=1
+            )
 
         if len(bars) > 0:
-            last_trading_day = APP.conf.last_trading_day
-            for bar in bars:
-                if bar.date == last_trading_day:
-                    logger.debug(f"{symbol} matched bar on {bar.date} with close {bar.close}")
-                    return bar.close
-
-            logger.warning(f"No adjusted close found for {symbol} on {last_trading_day}")
-            return None
+            self.pacing.report_success()
+            return {bar.date.strftime('%Y-%m-%d'): bar.close for bar in bars}
         else:
             logger.warning(f"No historical bars fetched for {symbol}")
+            return {}
+
+    async def fetch_snapshot_closes(self, contracts: Dict[str, Contract]) -> Dict[str, Optional[float]]:
+        """
+        Request market data snapshots for many contracts at once and return each symbol's previous close,
+        or None where the snapshot has no close (e.g. no market data permission or a timeout).
+        The close is not adjusted, so it only equals the ADJUSTED_LAST close without a corporate action since.
+        """
+        if not contracts:
+            return {}
+        symbols = list(contracts)
+        delayed = APP.conf.ib_snapshot_delayed
+        # snapshots are not historical data requests: they are paced by message rate and market data lines
+        async with self.market_data.slot(len(contracts)):
+            # the market data type applies to the whole connection: 4 (delayed-frozen, for accounts without
+            # a real-time subscription) is set while delayed snapshots are in flight, then live (1) is restored
+            if delayed:
+                if not self._delayed_snapshots:
+                    self.ib.reqMarketDataType(4)
+                self._delayed_snapshots += 1
+            try:
+                tickers = await asyncio.wait_for(self.ib.reqTickersAsync(*contracts.values()),
+                                                 APP.conf.ib_snapshot_timeout_sec)
+            except asyncio.TimeoutError:
+                logger.warning(f"Snapshot request for {len(symbols)} contracts timed out")
+                return dict.fromkeys(symbols)
+            finally:
+                if delayed:
+                    self._delayed_snapshots -= 1
+                    if not self._delayed_snapshots and self.is_connected():
+                        self.ib.reqMarketDataType(1)
+        self.market_data.report_success()
+
+        closes = {}
+        for symbol, ticker in zip(symbols, tickers):
+            close = ticker.close
+            closes[symbol] = close if close == close and close > 0 else None  # NaN when the tick never arrived
+        return closes
+
+    async def fetch_adjusted_close(self, symbol: str, contract: Optional[Contract] = None) -> Optional[float]:
+        """
+        contract skips resolution when it was already resolved, e.g. by resolve_contracts.
+        """
+        bars = await self.fetch_adjusted_bars(symbol, contract)
+        if not bars:
             return None
 
+        last_trading_day = APP.conf.last_trading_day.strftime('%Y-%m-%d')
+        if last_trading_day in bars:
+            logger.debug(f"{symbol} matched bar on {last_trading_day} with close {bars[last_trading_day]}")
+            return bars[last_trading_day]
+
+        logger.warning(f"No adjusted close found for {symbol} on {last_trading_day}")
+        return None
+
     async def update_cache(self, symbol: str, contract: Contract):
-        ib_data = {
+        await self.cache.update_metadata(symbol, ib_data=self._ib_data(contract))
+
+    @staticmethod
+    def _ib_data(contract: Contract) -> Dict[str, str]:
+        return {
             'conId': contract.conId,
             'currency': contract.currency,
             'description': contract.description,
@@ -114,4 +269,3 @@ class IBClient:
             'localSymbol': contract.localSymbol,
             'primaryExchange': contract.primaryExchange,
         }
-        await self.cache.update_metadata(symbol, ib_data=ib_data)
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable
+
+from app.config import APP
+
+logger = logging.getLogger(__name__)
+
+PACING_VIOLATION_CODE = 162
+MESSAGE_RATE_EXCEEDED_CODE = 100
+
+
+def is_pacing_violation(error_code: int, error_string: str) -> bool:
+    # 162 is also used for "HMDS query returned no data", only the pacing message counts
+    return error_code == PACING_VIOLATION_CODE and 'pacing violation' in error_string.lower()
+
+
+class PacingLimiter:
+    """
+    Models IB's historical data pacing rules for one client id:
+    - a token bucket caps the sustained request rate and its burst,
+    - identical requests are spaced by identical_interval_sec (15s),
+    - at most per_contract_max requests for one contract within per_contract_window_sec (5 in 2s),
+    - optionally at most window_max_requests within window_sec (60 in 10 minutes, 0 disables it),
+    - at most max_in_flight requests open at once.
+    A reported pacing violation halves the token rate and pauses the limiter with exponential backoff;
+    successful requests restore the rate additively.
+    """
+
+    def __init__(self, rate_per_sec: float = None, burst: int = None, max_in_flight: int = None,
+                 identical_interval_sec: float = None, per_contract_max: int = None,
+                 per_contract_window_sec: float = None, window_max_requests: int = None, window_sec: float = None):
+        conf = APP.conf
+        self.max_rate = rate_per_sec if rate_per_sec else conf.ib_pacing_rate_per_sec
+        self.burst = burst if burst else conf.ib_pacing_burst
+        self.identical_interval_sec = identical_interval_sec if identical_interval_sec is not None \
+            else conf.ib_pacing_identical_interval_sec
+        self.per_contract_max = per_contract_max if per_contract_max else conf.ib_pacing_per_contract_max
+        self.per_contract_window_sec = per_contract_window_sec if per_contract_window_sec is not None \
+            else conf.ib_pacing_per_contract_window_sec
+        self.window_max_requests = window_max_requests if window_max_requests is not None \
+            else conf.ib_pacing_window_max_requests
+        self.window_sec = window_sec if window_sec else conf.ib_pacing_window_sec
+
+        self.rate = self.max_rate
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._last_identical: Dict[Hashable, float] = {}
+        self._per_contract: Dict[Hashable, Deque[float]] = {}
+        self._window: Deque[float] = deque()
+        self._paused_until = 0.0
+        self._violation_streak = 0
+        self._lock = asyncio.Lock()
+        self._in_flight = asyncio.Semaphore(max_in_flight if max_in_flight else conf.ib_max_concurrent_requests)
+        self.violations = 0
+        self.waited_sec = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _delay(self, request_key: Hashable, contract_key: Hashable, now: float) -> float:
+        """
+        Seconds until a request may be sent without breaking any rule; 0 when it may go now.
+        """
+        self._refill(now)
+        delays = [self._paused_until - now, (1 - self._tokens) / self.rate]
+
+        last = self._last_identical.get(request_key)
+        if last is not None:
+            delays.append(last + self.identical_interval_sec - now)
+
+        recent = self._per_contract.get(contract_key)
+        if recent:
+            while recent and recent[0] <= now - self.per_contract_window_sec:
+                recent.popleft()
+            if len(recent) >= self.per_contract_max:
+                delays.append(recent[0] + self.per_contract_window_sec - now)
+
+        if self.window_max_requests:
+            while self._window and self._window[0] <= now - self.window_sec:
+                self._window.popleft()
+            if len(self._window) >= self.window_max_requests:
+                delays.append(self._window[0] + self.window_sec - now)
+        return max(delays)
+
+    def _record(self, request_key: Hashable, contract_key: Hashable, now: float):
+        self._tokens -= 1
+        self._last_identical[request_key] = now
+        self._per_contract.setdefault(contract_key, deque()).append(now)
+        if self.window_max_requests:
+            self._window.append(now)
+        # drop bookkeeping that can no longer delay a request
+        if len(self._last_identical) > 10000:
+            cutoff = now - self.identical_interval_sec
+            self._last_identical = {key: t for key, t in self._last_identical.items() if t > cutoff}
+            self._per_contract = {key: times for key, times in self._per_contract.items()
+                                  if times and times[-1] > now - self.per_contract_window_sec}
+
+    async def acquire(self, request_key: Hashable, contract_key: Hashable):
+        """
+        Wait until a request with the given identity may be sent, then account for it.
+        """
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                delay = self._delay(request_key, contract_key, now)
+                if delay <= 0:
+                    self._record(request_key, contract_key, now)
+                    return
+            self.waited_sec += delay
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def slot(self, request_key: Hashable, contract_key: Hashable):
+        async with self._in_flight:
+            await self.acquire(request_key, contract_key)
+            yield
+
+    def report_success(self):
+        self._violation_streak = 0
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def report_violation(self):
+        self.violations += 1
+        self._violation_streak += 1
+        self.rate = max(self.max_rate / 64, self.rate / 2)
+        backoff = min(APP.conf.ib_pacing_backoff_max_sec,
+                      APP.conf.ib_pacing_backoff_sec * 2 ** (self._violation_streak - 1))
+        self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+        self._tokens = min(self._tokens, 0)
+        logger.warning(f"IB pacing violation #{self.violations}: pausing {backoff:.1f}s, "
+                       f"rate lowered to {self.rate:.2f} req/s")
+
+    def stats(self) -> dict:
+        return {
+            'rate_per_sec': round(self.rate, 3),
+            'max_rate_per_sec': self.max_rate,
+            'violations': self.violations,
+            'waited_sec': round(self.waited_sec, 3),
+        }
+
+
+class MarketDataLimiter:
+    """
+    Paces market data snapshot requests for one client id, apart from the historical data limiter:
+    - a token bucket caps the reqMktData messages sent per second, one per contract,
+    - at most lines contracts hold a market data line at once.
+    A reported message rate violation (error 100) halves the rate; successful batches restore it additively.
+    """
+
+    def __init__(self, rate_per_sec: float = None, lines: int = None):
+        self.max_rate = rate_per_sec if rate_per_sec else APP.conf.ib_message_rate_per_sec
+        self.lines = lines if lines else APP.conf.ib_market_data_lines
+
+        self.rate = self.max_rate
+        self._tokens = float(self.max_rate)
+        self._refilled_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._lines_free = self.lines
+        self._lines_changed = asyncio.Condition()
+        self.violations = 0
+        self.waited_sec = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.max_rate, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def _send(self, count: int):
+        """
+        Wait until count messages may be sent. A batch larger than the bucket waits for a full bucket and
+        leaves a debt that delays the next batch.
+        """
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                needed = min(count, self.max_rate)
+                if self._tokens >= needed:
+                    self._tokens -= count
+                    return
+                delay = (needed - self._tokens) / self.rate
+            self.waited_sec += delay
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def slot(self, count: int):
+        """
+        Hold count market data lines while a batch of count snapshots is in flight.
+        """
+        if count > self.lines:
+            raise ValueError(f"{count} snapshots exceed the {self.lines} market data lines")
+        async with self._lines_changed:
+            await self._lines_changed.wait_for(lambda: self._lines_free >= count)
+            self._lines_free -= count
+        try:
+            await self._send(count)
+            yield
+        finally:
+            async with self._lines_changed:
+                self._lines_free += count
+                self._lines_changed.notify_all()
+
+    def report_success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def report_violation(self):
+        self.violations += 1
+        self.rate = max(self.max_rate / 64, self.rate / 2)
+        self._tokens = min(self._tokens, 0)
+        logger.warning(f"IB message rate exceeded #{self.violations}: rate lowered to {self.rate:.2f} msg/s")
+
+    def stats(self) -> dict:
+        return {
+            'rate_per_sec': round(self.rate, 3),
+            'max_rate_per_sec': self.max_rate,
+            'lines_in_use': self.lines - self._lines_free,
+            'violations': self.violations,
+            'waited_sec': round(self.waited_sec, 3),
+        }
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+from app.cache.contract_metadata_cache import ContractMetadataCache
+from app.config import APP
+from app.ib.ib_connection import IBConnection, IBConnectionManager
+from app.refinitiv.refinitiv import fetch_rics
+from app.utils import batch_symbols, is_market_hours
+
+logger = logging.getLogger(__name__)
+
+
+class ContractMetadataRefresher:
+    """
+    Periodically re-resolves RICs and IB contracts whose metadata is older than its TTL. Runs only outside
+    market hours, so request handlers keep serving cached (possibly stale) entries without paying for a lookup.
+    """
+
+    def __init__(self):
+        self.cache = ContractMetadataCache.instance()
+        self.interval_sec = APP.conf.metadata_refresh_interval_min * 60
+        self.batch_size = APP.conf.metadata_refresh_batch_size
+
+    async def run(self):
+        while True:
+            if is_market_hours():
+                logger.debug("Market is open, skipping contract metadata refresh")
+            else:
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    logger.exception(f"Contract metadata refresh failed: {e}")
+            await asyncio.sleep(self.interval_sec)
+
+    async def refresh(self):
+        await self.refresh_refinitiv()
+        await self.refresh_ib()
+
+    async def refresh_refinitiv(self):
+        stale = await self.cache.get_stale_symbols('refinitiv')
+        if not stale:
+            return
+        logger.info(f"Refreshing {len(stale)} stale RICs")
+        # fetch_rics uses the shared session kept open by RefinitivSessionManager
+        for batch in batch_symbols(stale, batch_size=self.batch_size):
+            rics = await fetch_rics(batch)
+            missing = [symbol for symbol, ric in rics.items() if ric is None]
+            if missing:
+                logger.warning(f"Could not refresh RIC for {len(missing)} symbols, keeping cached values: {missing[:20]}")
+
+    async def refresh_ib(self):
+        stale = await self.cache.get_stale_symbols('ib')
+        if not stale:
+            return
+        logger.info(f"Refreshing {len(stale)} stale IB contracts")
+        pool = IBConnectionManager.instance()
+
+        async def refresh_symbol(connection: IBConnection, symbol: str):
+            async with connection.request_slots:
+                try:
+                    if not await connection.client.request_contract(symbol):
+                        logger.warning(f"Could not refresh IB contract for {symbol}, keeping cached values")
+                except Exception as e:
+                    logger.warning(f"IB contract refresh for {symbol} failed: {e}")
+
+        for batch in batch_symbols(stale, batch_size=self.batch_size):
+            async with pool.lease() as connection:
+                await asyncio.gather(*[refresh_symbol(connection, symbol) for symbol in batch])
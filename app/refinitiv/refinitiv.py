@@ -1,18 +1,48 @@
 import asyncio
 import logging
 import re
-import time
 from datetime import datetime
 
 import pandas as pd
 import refinitiv.data as rd
-from refinitiv.data._errors import RDError
+from refinitiv.data._errors import RDError, SessionError, StreamConnectionError
 from refinitiv.data.content import symbol_conversion
 
 from app.cache.closing_prices_cache import ClosingPriceCache
 from app.cache.contract_metadata_cache import ContractMetadataCache
+from app.cache.negative_symbol_cache import NegativeSymbolCache, REFINITIV_NO_RIC
 from app.config import APP
-from app.utils import save_df_to_csv
+from app.refinitiv.session_manager import RefinitivSessionManager
+from app.retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy
+from app.single_flight import SingleFlight
+from app.utils import df_to_json_records, save_df_to_csv
+
+
+# errors worth retrying: timeouts, dropped connections and errors reported by the Refinitiv platform,
+# narrowed by is_upstream_failure so that request errors are neither retried nor counted by the breaker
+RETRYABLE_ERRORS = (asyncio.TimeoutError, ConnectionError, RDError)
+
+# get_data folds the errors of its underlying requests into RDError(-1, message); a server error then only
+# shows as the HTTP status quoted in the message
+SERVER_ERROR_STATUS = re.compile(r'\bstatus(?: code)?[: ]\s*5\d\d\b', re.IGNORECASE)
+
+CLOSE_FIELD = 'TR.PriceClose'
+CLOSE_COLUMN = 'Price Close'
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+    True for transport, session and server side (5xx) failures, False for errors caused by the request itself.
+    """
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, SessionError, StreamConnectionError)):
+        return True
+    if not isinstance(error, RDError):
+        return False
+    raw = getattr(getattr(error, 'response', None), 'raw', None)
+    statuses = [getattr(response, 'status_code', None) for response in (raw if isinstance(raw, list) else [raw])]
+    if any(isinstance(code, int) and 500 <= code < 600 for code in statuses + [error.code]):
+        return True
+    return bool(SERVER_ERROR_STATUS.search(str(error.message or '')))
 
 
 def convert_to_refinitiv_symbology(symbols):
@@ -28,6 +58,50 @@ def convert_to_refinitiv_symbology(symbols):
     return converted, ignored
 
 
+async def fetch_rics(symbols) -> dict:
+    """
+    Resolve tickers to RICs with Refinitiv symbol conversion and store them in the contract metadata cache.
+    Symbols without a match map to None; they only go to the negative cache when they have no cached RIC, so a
+    failed refresh keeps the cached one usable.
+    """
+    cache = ContractMetadataCache.instance()
+    async with RefinitivSessionManager.instance().request():
+        conversion_definition = await RetryPolicy(retry_on=RETRYABLE_ERRORS, is_failure=is_upstream_failure).call(
+            asyncio.to_thread,
+            symbol_conversion.Definition(
+                symbols=symbols,
+                from_symbol_type=symbol_conversion.SymbolTypes.TICKER_SYMBOL,
+                to_symbol_types=[symbol_conversion.SymbolTypes.RIC],
+                preferred_country_code=symbol_conversion.CountryCode.USA
+            ).get_data,
+            breaker=CircuitBreaker.for_upstream('refinitiv_symbol_conversion'))
+
+    converted_ric_list = {}
+    refinitiv_data = {}
+    for symbol in symbols:
+        try:
+            ric = conversion_definition.data.raw['Matches'][symbol]['RIC']
+            document_title = conversion_definition.data.raw['Matches'][symbol]['DocumentTitle']
+            converted_ric_list[symbol] = ric
+            refinitiv_data[symbol] = {
+                'title': re.split(r'[,;]', document_title)[0].strip(),
+                'ric': ric
+            }
+        except KeyError:
+            logging.warning(f"No RIC found for symbol '{symbol}'")
+            converted_ric_list[symbol] = None
+    await cache.update_many(refinitiv_data=refinitiv_data)
+
+    no_ric_symbols = [symbol for symbol, ric in converted_ric_list.items() if ric is None]
+    if no_ric_symbols:
+        metadata = await cache.get_many_metadata(no_ric_symbols)
+        no_ric_symbols = [symbol for symbol in no_ric_symbols
+                          if not (metadata[symbol] and metadata[symbol].get('refinitiv_ric'))]
+    if no_ric_symbols:
+        await NegativeSymbolCache.instance().add('refinitiv', no_ric_symbols, REFINITIV_NO_RIC)
+    return converted_ric_list
+
+
 async def convert_to_ric(symbols) -> dict:
     try:
         cache = ContractMetadataCache.instance()
@@ -35,37 +109,29 @@ async def convert_to_ric(symbols) -> dict:
 
         # fetch from cache
         symbols_to_fetch = []
+        cached = await cache.get_many_metadata(symbols)
         for symbol in symbols:
-            metadata = await cache.get_metadata(symbol)
+            metadata = cached[symbol]
             if metadata and metadata.get('refinitiv_ric'):
                 converted_ric_list[symbol] = metadata['refinitiv_ric']
             else:
                 symbols_to_fetch.append(symbol)
 
+        # known-unresolvable symbols are reported as having no RIC without a lookup
+        no_ric_symbols = await NegativeSymbolCache.instance().get_negative('refinitiv', symbols_to_fetch)
+        if no_ric_symbols:
+            logging.info(f"{len(no_ric_symbols)} symbols are in the negative cache: {sorted(no_ric_symbols)}")
+            converted_ric_list.update(dict.fromkeys(no_ric_symbols))
+            symbols_to_fetch = [symbol for symbol in symbols_to_fetch if symbol not in no_ric_symbols]
+
         # fetch from refinitiv symbols not in cache
         if symbols_to_fetch:
-            conversion_definition = symbol_conversion.Definition(
-                symbols=symbols_to_fetch,
-                from_symbol_type=symbol_conversion.SymbolTypes.TICKER_SYMBOL,
-                to_symbol_types=[symbol_conversion.SymbolTypes.RIC],
-                preferred_country_code=symbol_conversion.CountryCode.USA
-            ).get_data()
-
-            for symbol in symbols_to_fetch:
-                try:
-                    ric = conversion_definition.data.raw['Matches'][symbol]['RIC']
-                    document_title = conversion_definition.data.raw['Matches'][symbol]['DocumentTitle']
-                    converted_ric_list[symbol] = ric
-                    await cache.update_metadata(symbol, refinitiv_data={
-                        'title': re.split(r'[,;]', document_title)[0].strip(),
-                        'ric': ric
-                    })
-                except KeyError:
-                    logging.warning(f"No RIC found for symbol '{symbol}'")
-                    converted_ric_list[symbol] = None
+            converted_ric_list.update(await fetch_rics(symbols_to_fetch))
 
         return converted_ric_list
 
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logging.error(f"Error in converting symbols: {e}")
         return []
@@ -86,54 +152,68 @@ async def get_data(input_universe, input_fields, retries=3):
     if no_ric_symbols:
         logging.error(f"the following symbols had no ric symbol={no_ric_symbols}")
 
-    attempt = 0
-    while attempt < retries:
+    logging.info(f"requesting {input_fields} for {rics}")
+    # a session that does not open in time raises its ConnectionError from here, unchanged
+    async with RefinitivSessionManager.instance().request():
         try:
-            logging.info(f"Attempt {attempt + 1}: requesting {input_fields} for {rics}")
-            data_df = await asyncio.to_thread(rd.get_data, universe=rics, fields=input_fields)
-
-            data_df = data_df.infer_objects(copy=False)
-            logging.info(f"response: columns={data_df.columns.tolist()}, data count={len(data_df)}")
-
-            # replace RICs in no_data_symbols with their corresponding requested symbols
-            ric_to_symbol = {v: k for k, v in converted_symbols_dict.items()}
-            data_df['Instrument'] = data_df['Instrument'].map(ric_to_symbol).fillna(data_df['Instrument'])
-
-            return data_df, no_ric_symbols
-
-        except (asyncio.TimeoutError, RDError) as e:
-            logging.error(f"Error occurred during data retrieval: {str(e)}. Attempt {attempt + 1} failed.")
-            attempt += 1
-            time.sleep(2)
-            continue
-
+            # retries back off without blocking the event loop; while Refinitiv keeps failing the breaker
+            # rejects requests at once instead of tying up more worker threads
+            data_df = await RetryPolicy(attempts=retries, retry_on=RETRYABLE_ERRORS,
+                                        is_failure=is_upstream_failure).call(
+                asyncio.to_thread, rd.get_data, universe=rics, fields=input_fields,
+                breaker=CircuitBreaker.for_upstream('refinitiv_data'))
+        except CircuitOpenError:
+            raise
+        except RETRYABLE_ERRORS as e:
+            raise Exception(f"Failed to retrieve data after {retries} attempts: {e}") from e
         except Exception as e:
             logging.exception(f"An unexpected error occurred during data retrieval: {str(e)}")
             raise e
 
-    raise Exception(f"Failed to retrieve data after {retries} attempts")
+    data_df = data_df.infer_objects(copy=False)
+    logging.info(f"response: columns={data_df.columns.tolist()}, data count={len(data_df)}")
 
+    # replace RICs in no_data_symbols with their corresponding requested symbols
+    ric_to_symbol = {v: k for k, v in converted_symbols_dict.items()}
+    data_df['Instrument'] = data_df['Instrument'].map(ric_to_symbol).fillna(data_df['Instrument'])
 
-async def refinitiv_corporate_actions(input_universe, input_fields):
-    try:
-        data_df, no_ric_symbols = await get_data(input_universe, input_fields)
-        no_data_symbols = [symbol for symbol in input_universe if symbol not in data_df['Instrument'].values]
-
-        # filter only rows with date future value
-        today = pd.Timestamp(datetime.today().date())
-        filtered_df = data_df[data_df.iloc[:, 1:].apply(lambda row: row.notna() & (row == today), axis=1).any(axis=1)]
-
-        if not filtered_df.empty:
-            logging.info(f"found {len(filtered_df)} corporate actions")
-            logging.info(f"DataFrame saved to: {save_df_to_csv(filtered_df)}")
+    return data_df, no_ric_symbols
 
-        result = filtered_df.to_dict(orient='records')
 
-        # convert NaT to None for JSON serialization
-        for record in result:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
+async def refinitiv_corporate_actions(input_universe, input_fields, with_close_prices=False):
+    """
+    Corporate actions effective today. with_close_prices also stores the last trading day's Refinitiv closes,
+    requested in the same get_data call, so RICs are resolved once and a batch costs one round-trip.
+    """
+    try:
+        # symbols another request is already fetching today are awaited instead of requested again
+        single_flight = SingleFlight.instance()
+        trading_day = APP.conf.last_trading_day.strftime('%Y-%m-%d')
+        keys = [('refinitiv_corporate_actions', symbol, trading_day) for symbol in input_universe]
+        close_keys = [('refinitiv', symbol, trading_day) for symbol in input_universe] if with_close_prices else []
+        outcomes = {}  # { symbol: (records, has_data, has_ric) }
+        async with single_flight.flight(keys) as (owned, waiting), \
+                single_flight.flight(close_keys) as (close_owned, close_waiting):
+            owned_symbols = [symbol for _, symbol, _ in owned]
+            close_symbols = [symbol for _, symbol, _ in close_owned]
+            if owned_symbols or close_symbols:
+                outcomes.update(await _fetch_corporate_actions(owned_symbols, input_fields, close_symbols))
+            for key in owned:
+                single_flight.resolve(key, outcomes[key[1]])
+            for key in close_owned:
+                single_flight.resolve(key)
+            for (_, symbol, _), outcome in (await single_flight.wait(waiting)).items():
+                if isinstance(outcome, Exception):
+                    logging.error(f"Shared corporate actions fetch for {symbol} failed: {outcome}")
+                    outcome = ([], False, True)
+                records, has_data, has_ric = outcome
+                # the owner returns the same records, give this request its own copies
+                outcomes[symbol] = ([dict(record) for record in records], has_data, has_ric)
+            await single_flight.wait(close_waiting)
+
+        result = [record for symbol in dict.fromkeys(input_universe) for record in outcomes[symbol][0]]
+        no_data_symbols = [symbol for symbol in input_universe if not outcomes[symbol][1]]
+        no_ric_symbols = [symbol for symbol in input_universe if not outcomes[symbol][2]]
     except Exception as e:
         logging.exception(f"Failed to get data")
         raise e
@@ -141,36 +221,55 @@ async def refinitiv_corporate_actions(input_universe, input_fields):
     return result, no_data_symbols, no_ric_symbols
 
 
-async def refinitiv_fetch_close_prices(input_universe):
+async def _fetch_corporate_actions(input_universe, input_fields, close_symbols=()) -> dict:
+    """
+    Fetch corporate actions effective today and return { symbol: (records, has_data, has_ric) }.
+    The closes of close_symbols are requested in the same call and stored in the closing price cache.
+    """
+    fields = list(input_fields) if input_universe else []
+    if close_symbols:
+        fields.append(CLOSE_FIELD)
+    data_df, no_ric_symbols = await get_data(list(dict.fromkeys([*input_universe, *close_symbols])), fields)
+
+    if close_symbols:
+        await _store_close_prices(data_df[data_df['Instrument'].isin(close_symbols)])
+        data_df = data_df.drop(columns=[CLOSE_COLUMN], errors='ignore')
     if not input_universe:
-        logging.warning("Input symbols list is empty. Ignore fetch closing prices")
-        return
+        return {}
+    data_df = data_df[data_df['Instrument'].isin(input_universe)]
 
-    try:
-        cache = ClosingPriceCache.instance()
+    # filter only rows with a date of today, comparing whole datetime64 columns rather than row by row
+    today = pd.Timestamp(datetime.today().date())
+    dates_df = data_df.iloc[:, 1:].apply(pd.to_datetime, errors='coerce')
+    filtered_df = data_df[dates_df.eq(today).any(axis=1)]
 
-        # left_to_fetch = []
-        # for symbol in input_universe:
-        #     if symbol not in cache or 'refinitiv_close' not in cache[symbol] \
-        #             or cache[symbol]['date'] != APP.conf.last_trading_day.strftime('%Y-%m-%d'):
-        #         left_to_fetch.append(symbol)
+    if not filtered_df.empty:
+        logging.info(f"found {len(filtered_df)} corporate actions")
+        logging.info(f"DataFrame saved to: {save_df_to_csv(filtered_df)}")
 
-        if input_universe:
-            data_df, _ = await get_data(input_universe, ["TR.PriceClose"])
+    records_by_symbol = {}
+    for record in df_to_json_records(filtered_df):
+        records_by_symbol.setdefault(record['Instrument'], []).append(record)
 
-            if not data_df.empty:
-                reference_date = APP.conf.last_trading_day.strftime('%Y-%m-%d')
+    returned = set(data_df['Instrument'].values)
+    return {symbol: (records_by_symbol.get(symbol, []), symbol in returned, symbol not in no_ric_symbols)
+            for symbol in input_universe}
 
-                for _, row in data_df.iterrows():
-                    symbol = row["Instrument"]
-                    close_price = row.get("Price Close")
-                    if close_price is not None:
-                        await cache.set_refinitiv_close(symbol, close_price, reference_date)
-                    else:
-                        logging.warning(f"No close price found for symbol '{symbol}'")
 
+async def _store_close_prices(data_df):
+    try:
+        if data_df.empty:
+            return
+        if CLOSE_COLUMN not in data_df.columns:
+            logging.warning(f"No close prices found for symbols {data_df['Instrument'].tolist()}")
+            return
+        # rows of multi-valued fields leave the close empty after an instrument's first row
+        close_prices = data_df.dropna(subset=[CLOSE_COLUMN]).drop_duplicates(subset="Instrument") \
+            .set_index("Instrument")[CLOSE_COLUMN]
+        await ClosingPriceCache.instance().set_refinitiv_closes(close_prices,
+                                                               APP.conf.last_trading_day.strftime('%Y-%m-%d'))
     except Exception as e:
-        logging.error(f"Error fetching close prices: {e}")
+        logging.error(f"Error storing close prices: {e}")
 
 
 async def fetch_holdings_for_symbol(symbol):
@@ -208,7 +307,5 @@ async def fetch_holdings_for_symbol(symbol):
     except Exception as e:
         logging.exception(f"Failed to fetch holdings data")
         raise e
-    finally:
-        rd.close_session()
 
     return result, no_ric_symbols
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import re
+import time
+from datetime import date
+from typing import Awaitable, Callable, Dict, List, Sequence, TypeVar
+
+from app.config import APP
+from app.refinitiv.refinitiv import is_upstream_failure
+from app.retry_policy import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+DATE_RANGE = re.compile(r'SDate=(\d{4}-\d{2}-\d{2}),\s*EDate=(\d{4}-\d{2}-\d{2})')
+
+
+def field_cost(field: str) -> float:
+    """
+    Relative cost of one field for one instrument. A field over a date range returns a row per event in the
+    range, so it costs more the more years it covers.
+    """
+    match = DATE_RANGE.search(field)
+    if not match:
+        return 1.0
+    days = (date.fromisoformat(match.group(2)) - date.fromisoformat(match.group(1))).days
+    return 1.0 + max(days, 0) / 365 * APP.conf.refinitiv_cost_per_field_year
+
+
+def _root_cause(error: BaseException) -> BaseException:
+    # get_data reports failed retries as an Exception raised from the original error
+    while error.__cause__ is not None:
+        error = error.__cause__
+    return error
+
+
+class RefinitivRequestScheduler:
+    """
+    Splits a universe into batches and runs them with at most REFINITIV_MAX_CONCURRENT_REQUESTS requests in flight
+    across all callers. Batches are sized by a cost budget: a symbol costs the sum of its fields' costs, so a batch
+    of wide date-range fields holds fewer symbols. The budget adapts to observed latency and errors: it grows
+    additively while requests finish within REFINITIV_TARGET_LATENCY_SEC, shrinks in proportion to slower ones
+    and halves on a timeout or upstream failure. Errors caused by the request itself leave it unchanged, and
+    batches the circuit breaker rejected are not observed at all, since no request was sent.
+    """
+    _instance = None
+
+    def __init__(self, max_concurrent: int = None, target_latency_sec: float = None):
+        conf = APP.conf
+        self.max_concurrent = max_concurrent if max_concurrent else conf.refinitiv_max_concurrent_requests
+        self.target_latency_sec = target_latency_sec if target_latency_sec else conf.refinitiv_target_latency_sec
+        self.initial_budget = conf.refinitiv_batch_cost_budget
+        self.min_budget = conf.refinitiv_batch_cost_min
+        self.max_budget = conf.refinitiv_batch_cost_max
+        self.budget = float(self.initial_budget)
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.error_rate = 0.0  # exponentially weighted
+        self.avg_latency_sec = 0.0  # exponentially weighted
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def symbol_cost(fields: Sequence[str]) -> float:
+        return sum(field_cost(field) for field in fields)
+
+    def batch_size(self, fields: Sequence[str]) -> int:
+        return max(1, min(APP.conf.refinitiv_max_batch_size, int(self.budget // self.symbol_cost(fields))))
+
+    def _observe(self, latency_sec: float, failed: bool, upstream_failure: bool = False):
+        self.requests += 1
+        self.failures += int(failed)
+        self.error_rate = 0.8 * self.error_rate + 0.2 * int(failed)
+        if upstream_failure:
+            self.budget *= 0.5
+        elif not failed:
+            self.avg_latency_sec = latency_sec if self.requests == 1 else \
+                0.8 * self.avg_latency_sec + 0.2 * latency_sec
+            if latency_sec <= self.target_latency_sec:
+                self.budget += self.initial_budget * 0.1
+            else:
+                self.budget *= max(0.5, self.target_latency_sec / latency_sec)
+        self.budget = min(self.max_budget, max(self.min_budget, self.budget))
+
+    async def run(self, symbols: Sequence[str], fields: Sequence[str],
+                  fetch: Callable[[List[str]], Awaitable[T]],
+                  on_error: Callable[[List[str], Exception], T]) -> List[T]:
+        """
+        Call fetch for batches of symbols requesting fields and return the results in batch order, which
+        follows symbols whatever order the batches complete in. A batch whose fetch raises contributes
+        on_error(batch, error) instead.
+        """
+        pending = list(symbols)
+        batches: List[List[str]] = []
+        results: Dict[int, T] = {}  # { batch number: result }
+
+        async def worker():
+            while pending:
+                async with self._slots:
+                    # the batch is cut once a slot is free, so it uses the budget as adapted by earlier batches
+                    if not pending:
+                        return
+                    size = self.batch_size(fields)
+                    batch, pending[:size] = pending[:size], []
+                    number = len(batches)
+                    batches.append(batch)
+                    self.in_flight += 1
+                    t0 = time.monotonic()
+                    try:
+                        result = await fetch(batch)
+                    except Exception as e:
+                        cause = _root_cause(e)
+                        if not isinstance(cause, CircuitOpenError):
+                            self._observe(time.monotonic() - t0, failed=True,
+                                          upstream_failure=is_upstream_failure(cause))
+                        logger.error(f"Refinitiv batch of {len(batch)} symbols failed: {e}")
+                        result = on_error(batch, e)
+                    else:
+                        self._observe(time.monotonic() - t0, failed=False)
+                    finally:
+                        self.in_flight -= 1
+                results[number] = result
+
+        workers = min(self.max_concurrent, len(pending))
+        logger.info(f"Scheduling {len(pending)} symbols in batches of about {self.batch_size(fields)} "
+                    f"with {workers} concurrent requests")
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        return [results[number] for number in range(len(batches))]
+
+    def stats(self) -> dict:
+        return {
+            'budget': round(self.budget, 1),
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'failures': self.failures,
+            'error_rate': round(self.error_rate, 3),
+            'avg_latency_sec': round(self.avg_latency_sec, 3),
+        }
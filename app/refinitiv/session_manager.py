@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Set
+
+import refinitiv.data as rd
+
+from app.config import APP
+
+logger = logging.getLogger(__name__)
+
+# session events after which the session cannot serve requests until it is opened again
+REOPEN_EVENTS = {
+    rd.session.EventCode.SessionAuthenticationFailed,
+    rd.session.EventCode.SessionDisconnected,
+}
+
+
+class RefinitivSessionManager:
+    """
+    App-scoped Refinitiv platform session, opened once and set as the rd default session for every caller.
+    A supervisor task keeps it open: it reopens the session with exponential backoff after an authentication
+    failure or disconnect, and renews it every REFINITIV_SESSION_RENEW_MIN minutes with a fresh password grant
+    before the refresh token lapses. A renewal opens the new session before closing the old one, and requests
+    made through request() are counted per session, so the old one is closed once its requests drain or after
+    REFINITIV_SESSION_DRAIN_TIMEOUT_SEC.
+    """
+    _instance = None
+
+    def __init__(self):
+        self.session = None
+        self.opened_at: Optional[float] = None
+        self.reopens = 0
+        self.last_error: Optional[str] = None
+        self._open = asyncio.Event()
+        self._reopen_needed = asyncio.Event()
+        self._supervisor_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closed = False
+        self._in_flight: Dict[int, int] = {}  # { id(session): requests }
+        self._drained = asyncio.Condition()
+        self._drain_tasks: Set[asyncio.Task] = set()
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def state(self) -> str:
+        if self._closed:
+            return 'closed'
+        if self.is_open():
+            return 'open'
+        return 'opening' if self._supervisor_task else 'not_started'
+
+    def is_open(self) -> bool:
+        return self.session is not None and self.session.open_state == rd.OpenState.Opened
+
+    def start(self):
+        if self._supervisor_task is None and not self._closed:
+            self._loop = asyncio.get_running_loop()
+            self._supervisor_task = self._loop.create_task(self._supervise())
+
+    async def close(self):
+        self._closed = True
+        if self._supervisor_task:
+            self._supervisor_task.cancel()
+            try:
+                await self._supervisor_task
+            except asyncio.CancelledError:
+                pass
+        # replaced sessions still draining are closed right away
+        for task in list(self._drain_tasks):
+            task.cancel()
+        await asyncio.gather(*self._drain_tasks, return_exceptions=True)
+        self._open.clear()
+        if self.session is not None:
+            await asyncio.to_thread(self._close_session, self.session)
+            self.session = None
+
+    async def wait_open(self, timeout: float = None):
+        """
+        Wait up to timeout seconds until the session is open, starting the supervisor on first use.
+        """
+        if self._closed:
+            raise ConnectionError("Refinitiv session manager is closed")
+        self.start()
+        if self.is_open():
+            return
+        self._open.clear()
+        self._reopen_needed.set()
+        timeout = APP.conf.refinitiv_session_timeout_sec if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self._open.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Refinitiv session is not open after {timeout} seconds: {self.last_error}")
+
+    @asynccontextmanager
+    async def request(self, timeout: float = None) -> AsyncIterator:
+        """
+        Wait for the session like wait_open and count the request against it until the block exits,
+        so a renewal does not close the session under it.
+        """
+        await self.wait_open(timeout)
+        key = id(self.session)
+        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        try:
+            yield self.session
+        finally:
+            self._in_flight[key] -= 1
+            if not self._in_flight[key]:
+                del self._in_flight[key]
+                async with self._drained:
+                    self._drained.notify_all()
+
+    async def _close_when_drained(self, session):
+        key = id(session)
+        timeout = APP.conf.refinitiv_session_drain_timeout_sec
+        try:
+            async with self._drained:
+                await asyncio.wait_for(self._drained.wait_for(lambda: key not in self._in_flight), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Closing replaced Refinitiv session with {self._in_flight.get(key)} requests "
+                           f"still in flight after {timeout} seconds")
+        finally:
+            await asyncio.to_thread(self._close_session, session)
+
+    def _open_session(self):
+        conf = APP.conf
+        logger.info("Connecting to refiniv...")
+        session = rd.session.platform.Definition(
+            app_key=conf.refinitiv_app_key,
+            signon_control=True,
+            grant=rd.session.platform.GrantPassword(
+                username=conf.refinitiv_username,
+                password=conf.refinitiv_password
+            )
+        ).get_session()
+        rd.get_config()["http.request-timeout"] = 300
+        rd.get_config()["http.connect-timeout"] = 300
+        session.on_event(self._on_event)
+        session.open()
+        if session.open_state != rd.OpenState.Opened:
+            self._close_session(session)
+            raise ConnectionError(f"session state is {session.open_state}")
+        rd.session.set_default(session)
+        logger.info(f"Connected to refiniv. SessionId={session.open_state}, ServerMode={session.server_mode}")
+        return session
+
+    @staticmethod
+    def _close_session(session):
+        try:
+            session.close()
+        except Exception as e:
+            logger.warning(f"Error while closing Refinitiv session: {e}")
+
+    async def _supervise(self):
+        while not self._closed:
+            await self._open_with_backoff()
+            await self._monitor()
+
+    async def _open_with_backoff(self):
+        delay = APP.conf.refinitiv_reconnect_min_sec
+        while not self._closed:
+            try:
+                previous, self.session = self.session, await asyncio.to_thread(self._open_session)
+                self.opened_at = time.monotonic()
+                self.last_error = None
+                self._reopen_needed.clear()
+                self._open.set()
+                # the new session is the default by now, the old one only serves requests already in flight
+                if previous is not None:
+                    task = asyncio.create_task(self._close_when_drained(previous))
+                    self._drain_tasks.add(task)
+                    task.add_done_callback(self._drain_tasks.discard)
+                return
+            except Exception as e:
+                self.last_error = str(e) or type(e).__name__
+                sleep_for = delay * random.uniform(0.8, 1.2)
+                logger.warning(f"Opening Refinitiv session failed ({self.last_error}), "
+                               f"retrying in {sleep_for:.1f} seconds")
+                await asyncio.sleep(sleep_for)
+                delay = min(delay * 2, APP.conf.refinitiv_reconnect_max_sec)
+
+    async def _monitor(self):
+        """
+        Wait until the session needs reopening: it reported a failure, stopped being open or is due for renewal.
+        """
+        renew_sec = APP.conf.refinitiv_session_renew_min * 60
+        while not self._closed:
+            timeout = APP.conf.refinitiv_health_check_interval_sec
+            if renew_sec:
+                timeout = max(0.0, min(timeout, self.opened_at + renew_sec - time.monotonic()))
+            try:
+                await asyncio.wait_for(self._reopen_needed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            if renew_sec and time.monotonic() - self.opened_at >= renew_sec:
+                logger.info("Renewing Refinitiv session")
+            elif self._reopen_needed.is_set() or not self.is_open():
+                logger.warning(f"Refinitiv session lost ({self.last_error}), reopening")
+                self._open.clear()
+            else:
+                continue
+            self.reopens += 1
+            return
+
+    def _on_event(self, event_code, message, session):
+        # called from the library's threads
+        if event_code in REOPEN_EVENTS and session is self.session and not self._closed and self._loop is not None:
+            self.last_error = f"{event_code}: {message}"
+            self._loop.call_soon_threadsafe(self._reopen_needed.set)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type, TypeVar
+
+from app.config import APP
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Per-upstream circuit breaker, registered by name. After failure_threshold consecutive failures the circuit
+    opens and calls fail fast for reset_timeout_sec; then one trial call is let through (half open), which
+    closes the circuit on success or opens it again on failure.
+    """
+    _registry: Dict[str, 'CircuitBreaker'] = {}
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout_sec: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold if failure_threshold else APP.conf.breaker_failure_threshold
+        self.reset_timeout_sec = reset_timeout_sec if reset_timeout_sec else APP.conf.breaker_reset_timeout_sec
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self.rejected = 0
+        self.last_error: Optional[str] = None
+
+    @classmethod
+    def for_upstream(cls, name: str) -> 'CircuitBreaker':
+        if name not in cls._registry:
+            cls._registry[name] = cls(name)
+        return cls._registry[name]
+
+    @classmethod
+    def states(cls) -> Dict[str, dict]:
+        return {name: breaker.snapshot() for name, breaker in cls._registry.items()}
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.reset_timeout_sec:
+            return 'open'
+        return 'half_open'
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError when the call must not reach the upstream.
+        """
+        state = self.state
+        if state == 'closed':
+            return
+        if state == 'half_open' and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(f"{self.name} circuit is open after {self._failures} failures: {self.last_error}")
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info(f"{self.name} circuit closed")
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self, error: BaseException):
+        self._failures += 1
+        self.last_error = str(error) or type(error).__name__
+        if self._trial_in_flight or self._failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"{self.name} circuit opened for {self.reset_timeout_sec}s after "
+                               f"{self._failures} failures: {self.last_error}")
+            self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+    def release_trial(self):
+        """
+        The call ended without telling whether the upstream recovered, e.g. it was cancelled; let another trial in.
+        """
+        self._trial_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self._failures,
+            'rejected': self.rejected,
+            'last_error': self.last_error,
+        }
+
+
+class RetryPolicy:
+    """
+    Async retries with exponential backoff and full jitter. Only exceptions of the retry_on types that pass the
+    optional is_failure check are retried and count as upstream failures for the circuit breaker; others
+    propagate at once.
+    """
+
+    def __init__(self, attempts: int = None, base_delay_sec: float = None, max_delay_sec: float = None,
+                 retry_on: Tuple[Type[BaseException], ...] = (asyncio.TimeoutError, ConnectionError),
+                 is_failure: Callable[[BaseException], bool] = None):
+        self.attempts = attempts if attempts else APP.conf.retry_attempts
+        self.base_delay_sec = base_delay_sec if base_delay_sec is not None else APP.conf.retry_base_delay_sec
+        self.max_delay_sec = max_delay_sec if max_delay_sec is not None else APP.conf.retry_max_delay_sec
+        self.retry_on = retry_on
+        self.is_failure = is_failure
+
+    def delay(self, attempt: int) -> float:
+        # full jitter keeps callers that failed together from retrying together
+        return random.uniform(0, min(self.max_delay_sec, self.base_delay_sec * 2 ** attempt))
+
+    async def call(self, fn: Callable[..., Awaitable[T]], *args, breaker: CircuitBreaker = None, **kwargs) -> T:
+        for attempt in range(self.attempts):
+            if breaker:
+                breaker.before_call()
+            try:
+                result = await fn(*args, **kwargs)
+            except self.retry_on as e:
+                if self.is_failure and not self.is_failure(e):
+                    # the upstream answered, the request itself was bad: neither retry nor blame the upstream
+                    if breaker:
+                        breaker.release_trial()
+                    raise
+                if breaker:
+                    breaker.record_failure(e)
+                if attempt + 1 >= self.attempts or (breaker and breaker.state == 'open'):
+                    raise
+                delay = self.delay(attempt)
+                logger.warning(f"Attempt {attempt + 1}/{self.attempts} failed: {e or type(e).__name__}, "
+                               f"retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+            except BaseException:
+                if breaker:
+                    breaker.release_trial()
+                raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                return result
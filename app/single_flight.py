@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Hashable, Iterable, List, Tuple
+
+from app.cache.cache_metrics import CacheMetrics
+
+# (source, symbol, trading day)
+FlightKey = Tuple[str, str, str]
+
+
+def _consume_exception(future: asyncio.Future):
+    # a failed flight may have no waiters, keep asyncio from logging "exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent upstream fetches of the same key. The first caller to claim a key owns it and must
+    resolve it; callers that claim it while it is in flight await the owner's result instead of fetching again.
+    """
+    _instance = None
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self._metrics = CacheMetrics.for_cache("single_flight")
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def claim(self, keys: Iterable[Hashable]) -> Tuple[List[Hashable], Dict[Hashable, asyncio.Future]]:
+        """
+        Return (owned keys, { key: future } of keys another caller is already fetching).
+        """
+        owned, waiting = [], {}
+        loop = asyncio.get_running_loop()
+        for key in dict.fromkeys(keys):
+            future = self._in_flight.get(key)
+            if future is None:
+                future = loop.create_future()
+                future.add_done_callback(_consume_exception)
+                self._in_flight[key] = future
+                owned.append(key)
+            else:
+                waiting[key] = future
+        self._metrics.inc('owned', len(owned))
+        self._metrics.inc('coalesced', len(waiting))
+        if waiting:
+            logging.info(f"{len(waiting)} fetches joined requests already in flight")
+        return owned, waiting
+
+    def resolve(self, key: Hashable, result: Any = None):
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def fail(self, key: Hashable, error: BaseException):
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_exception(error)
+
+    @staticmethod
+    async def wait(waiting: Dict[Hashable, asyncio.Future]) -> Dict[Hashable, Any]:
+        """
+        Await the owners' results. A failed flight maps to its exception, so one failure does not hide the rest.
+        """
+        if not waiting:
+            return {}
+        # shielded, so a cancelled waiter does not cancel the flight for the others
+        results = await asyncio.gather(*[asyncio.shield(future) for future in waiting.values()],
+                                       return_exceptions=True)
+        return dict(zip(waiting, results))
+
+    @asynccontextmanager
+    async def flight(self, keys: Iterable[Hashable]):
+        """
+        claim() the keys and yield (owned, waiting). Owned keys still unresolved on exit are failed, so waiters
+        never hang on an owner that raised or forgot a key.
+        """
+        owned, waiting = self.claim(keys)
+        try:
+            yield owned, waiting
+        except BaseException as e:
+            for key in owned:
+                self.fail(key, e if isinstance(e, Exception) else RuntimeError(f"in-flight fetch aborted: {e!r}"))
+            raise
+        finally:
+            for key in owned:
+                self.fail(key, RuntimeError(f"in-flight fetch for {key} ended without a result"))
@@ -1,8 +1,9 @@
 import logging
 import os
 import time
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
 
+import numpy as np
 import pandas as pd
 import pandas_market_calendars as mcal
 from pytz import timezone
@@ -21,6 +22,24 @@ def serialize_timestamps(obj):
     return obj
 
 
+def df_to_json_records(df: pd.DataFrame) -> list:
+    """
+    Rows of df as JSON-ready dicts, converted a column at a time: datetimes become ISO strings and NaT/NaN None.
+    """
+    columns = []
+    for column in df.columns:
+        values = df[column]
+        missing = values.isna().to_numpy()
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = np.datetime_as_string(values.to_numpy(dtype='datetime64[s]'), unit='s').astype(object)
+        else:
+            values = values.to_numpy(dtype=object)
+        values[missing] = None
+        columns.append(values.tolist())
+    names = list(df.columns)
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
 def save_df_to_csv(df, file_prefix='corporate_actions', folder='data_output'):
     os.makedirs(folder, exist_ok=True)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -37,6 +56,35 @@ def is_after_market_open():
     return now_et.time() >= market_open
 
 
+def is_after_market_close():
+    """
+    True from the NYSE close until midnight on a weekday (holidays are not considered).
+    """
+    eastern = timezone('US/Eastern')
+    now_et = datetime.now(eastern)
+    return now_et.weekday() < 5 and now_et.time() >= time(16, 0)
+
+
+def is_market_hours():
+    """
+    True during the regular NYSE session on a weekday (holidays are not considered).
+    """
+    eastern = timezone('US/Eastern')
+    now_et = datetime.now(eastern)
+    return now_et.weekday() < 5 and time(9, 30) <= now_et.time() < time(16, 0)
+
+
+def get_trading_days(end_date, count):
+    """
+    Return the last count NYSE trading days up to and including end_date as 'YYYY-MM-DD' strings, oldest first.
+    """
+    end_date = pd.to_datetime(end_date).date()
+    nyse = mcal.get_calendar('NYSE')
+    # two calendar days per trading day plus holiday slack always covers count sessions
+    trading_days = nyse.valid_days(start_date=end_date - timedelta(days=2 * count + 10), end_date=end_date).tz_localize(None)
+    return [day.strftime('%Y-%m-%d') for day in trading_days[-count:]]
+
+
 def get_previous_trading_day(reference_date=None):
     """
     Return the previous trading day using the NYSE calendar.
@@ -47,9 +95,10 @@ def get_previous_trading_day(reference_date=None):
     else:
         reference_date = pd.to_datetime(reference_date).date()
 
+    # a short lookback always contains a trading day; valid_days avoids building the full session schedule,
+    # which keeps this cheap at import time
     nyse = mcal.get_calendar('NYSE')
-    schedule = nyse.schedule(start_date='2000-01-01', end_date=reference_date)
-    trading_days = schedule.index
+    trading_days = nyse.valid_days(start_date=reference_date - timedelta(days=30), end_date=reference_date).tz_localize(None)
 
     # Find the last trading day before the reference date
     previous_days = trading_days[trading_days < pd.Timestamp(reference_date)]
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 from datetime import datetime
@@ -5,13 +6,19 @@ from datetime import datetime
 import aiojobs as aiojobs
 import refinitiv.data as rd
 from aiohttp import web
-from aiojobs.aiohttp import setup
+from aiojobs.aiohttp import setup, get_scheduler_from_app
 
 from app.cache.closing_prices_cache import ClosingPriceCache
 from app.cache.contract_metadata_cache import ContractMetadataCache
+from app.cache.fetch_run_store import FetchRunStore
+from app.cache.negative_symbol_cache import NegativeSymbolCache
 from app.config import APP
-from app.handlers import health_check, get_holdings, filter_daily_corporate_action_handler, \
-    fetch_ib_last_adj_price_handler
+from app.handlers import health_check, readiness_check, get_holdings, filter_daily_corporate_action_handler, \
+    fetch_ib_last_adj_price_handler, list_negative_cache_handler, purge_negative_cache_handler, \
+    cache_metrics_handler, fetch_run_handler
+from app.ib.ib_connection import IBConnectionManager
+from app.metadata_refresher import ContractMetadataRefresher
+from app.refinitiv.session_manager import RefinitivSessionManager
 
 
 def exception_handler(scheduler: aiojobs.Scheduler, context: dict):
@@ -20,11 +27,22 @@ def exception_handler(scheduler: aiojobs.Scheduler, context: dict):
         logging.error("exception handler", exc_info=exception)
 
 
+async def warm_up_caches():
+    await asyncio.to_thread(lambda: APP.conf.last_trading_day)
+    logging.info(f"Last trading day={APP.conf.last_trading_day}")
+    await asyncio.gather(ClosingPriceCache.instance().warm_up.start(), ContractMetadataCache.instance().warm_up.start(),
+                         NegativeSymbolCache.instance().warm_up.start(), FetchRunStore.instance().warm_up.start())
+
+
 async def on_startup(app: web.Application):
     logging.info("setting up application")
-    logging.info(f"Last trading day={APP.conf.last_trading_day}")
-    ClosingPriceCache.instance()
-    ContractMetadataCache.instance()
+    # the caches load in the background so the port is bound right away; /health_check/ready reports when they are hot
+    await get_scheduler_from_app(app).spawn(warm_up_caches())
+    IBConnectionManager.instance().start()
+    # the shared Refinitiv session opens in the background, requests wait for it
+    RefinitivSessionManager.instance().start()
+    if APP.conf.metadata_refresh_enabled:
+        await get_scheduler_from_app(app).spawn(ContractMetadataRefresher().run())
 
     root_directory = os.path.dirname(os.path.abspath(__file__))
     log_directory = os.path.join(root_directory, 'logs')
@@ -40,6 +58,16 @@ async def on_startup(app: web.Application):
     APP.refinitive_config.set_param("logs.level", "debug")
 
 
+async def on_cleanup(app: web.Application):
+    await IBConnectionManager.instance().close()
+    await RefinitivSessionManager.instance().close()
+    logging.info("flushing caches")
+    await ContractMetadataCache.instance().close()
+    await NegativeSymbolCache.instance().close()
+    await FetchRunStore.instance().close()
+    await ClosingPriceCache.instance().close()
+
+
 def application_init():
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(name)s - %(levelname)s - [%(threadName)s] - %(message)s')
@@ -52,11 +80,17 @@ def application_init():
     logging.info("init refinitive-data-service")
     webapp = web.Application(client_max_size=1024 ** 2 * 50)  # Set limit to 50 MB
     webapp.router.add_get('/health_check', health_check)
+    webapp.router.add_get('/health_check/ready', readiness_check)
+    webapp.router.add_get('/metrics/caches', cache_metrics_handler)
     webapp.router.add_get('/refinitive/holdings', get_holdings)
     webapp.router.add_post('/refinitive/corporate_actions/validate', filter_daily_corporate_action_handler)
     webapp.router.add_post('/ib/last_adj_close', fetch_ib_last_adj_price_handler)
+    webapp.router.add_get('/ib/fetch_runs/{run_id}', fetch_run_handler)
+    webapp.router.add_get('/admin/negative_cache', list_negative_cache_handler)
+    webapp.router.add_delete('/admin/negative_cache', purge_negative_cache_handler)
     setup(webapp, exception_handler=exception_handler, pending_limit=100)
     webapp.on_startup.append(on_startup)
+    webapp.on_cleanup.append(on_cleanup)
     return webapp
 
 
@@ -0,0 +1,77 @@
+import argparse
+import gc
+import logging
+import tracemalloc
+from datetime import datetime
+
+from app.cache.contract_meta_data_schema import FIELDNAMES
+from app.cache.contract_record import ContractRecord
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - [%(threadName)s] - %(message)s')
+logger = logging.getLogger(__name__)
+
+EXCHANGES = ['ARCA', 'NASDAQ', 'NYSE', 'BATS', 'AMEX']
+
+
+def make_values(i: int) -> dict:
+    """
+    A row as populated by ContractMetadataCache.update_metadata, with fresh string objects as read from CSV.
+    """
+    now = datetime.utcnow().isoformat()
+    symbol = f"S{i:07d}"
+    return {
+        'symbol': symbol,
+        'refinitiv_title': f"{symbol} Holdings Inc",
+        'refinitiv_ric': f"{symbol}.O",
+        'ib_conid': str(1000000 + i),
+        'ib_primary_exchange': ''.join(EXCHANGES[i % len(EXCHANGES)]),
+        'ib_exchange': ''.join(['SM', 'ART']),
+        'ib_under_sec_type': ''.join(['ST', 'K']),
+        'ib_currency': ''.join(['US', 'D']),
+        'created_time': now,
+        'update_time': now,
+    }
+
+
+def build_dicts(size: int):
+    records = {}
+    for i in range(size):
+        record = {field: '' for field in FIELDNAMES}
+        record.update(make_values(i))
+        records[record['symbol']] = record
+    return records
+
+
+def build_records(size: int):
+    records = {}
+    header = list(FIELDNAMES)
+    for i in range(size):
+        values = make_values(i)
+        record = ContractRecord.from_values(header, [values.get(field, '') for field in header])
+        records[record.symbol] = record
+    return records
+
+
+def measure(builder, size: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    records = builder(size)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    gc.collect()
+    return current
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Memory used by contract metadata cache entries")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    logger.info(f"{'symbols':>10} {'dict (MB)':>12} {'record (MB)':>12} {'bytes/dict':>12} {'bytes/record':>13} {'ratio':>7}")
+    for size in args.sizes:
+        dict_bytes = measure(build_dicts, size)
+        record_bytes = measure(build_records, size)
+        logger.info(f"{size:>10} {dict_bytes / 2 ** 20:>12.1f} {record_bytes / 2 ** 20:>12.1f} "
+                    f"{dict_bytes // size:>12} {record_bytes // size:>13} {dict_bytes / record_bytes:>7.1f}")
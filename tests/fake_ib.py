@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import math
+import random
+import time
+from collections import deque
+from datetime import date
+from functools import lru_cache
+from typing import Deque, Dict, List, Optional, Tuple
+
+from eventkit import Event
+from ib_insync import BarData, Contract, ContractDetails, Ticker
+
+import app.ib.ibclient as ibclient
+from app.config import APP
+from app.utils import get_trading_days
+
+PACING_VIOLATION = (162, "Historical Market Data Service error message:API historical data query cancelled: "
+                         "pacing violation")
+NO_DATA = (162, "Historical Market Data Service error message:HMDS query returned no data")
+NO_CONTRACT = (200, "No security definition has been found for the request")
+
+
+class GatewayProfile:
+    """
+    Behaviour of the simulated gateway, shared by every FakeIB connection created by install().
+    Latencies are lognormal, given by their median and p99 in milliseconds.
+    """
+
+    def __init__(self, latency_ms: float = 50, latency_p99_ms: float = 400, error_rate: float = 0.0,
+                 no_contract_rate: float = 0.0, identical_interval_sec: float = 15, per_contract_max: int = 6,
+                 per_contract_window_sec: float = 2, window_max_requests: int = 0, window_sec: float = 600,
+                 max_rate_per_sec: float = 0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.latency_p99_ms = latency_p99_ms
+        self.error_rate = error_rate
+        self.no_contract_rate = no_contract_rate
+        self.identical_interval_sec = identical_interval_sec
+        self.per_contract_max = per_contract_max
+        self.per_contract_window_sec = per_contract_window_sec
+        self.window_max_requests = window_max_requests  # 0 disables the rolling window rule
+        self.window_sec = window_sec
+        self.max_rate_per_sec = max_rate_per_sec  # 0 disables the request rate rule
+        self.random = random.Random(seed)
+
+    def latency(self) -> float:
+        """
+        One latency sample in seconds.
+        """
+        if self.latency_p99_ms <= self.latency_ms:
+            return self.latency_ms / 1000
+        sigma = math.log(self.latency_p99_ms / self.latency_ms) / 2.326  # z score of the 99th percentile
+        return self.random.lognormvariate(math.log(self.latency_ms), sigma) / 1000
+
+    def has_contract(self, symbol: str) -> bool:
+        # stable per symbol, so a missing contract stays missing across lookups and runs
+        digest = hashlib.md5(symbol.encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 >= self.no_contract_rate
+
+
+class GatewayStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.contract_requests = 0
+        self.historical_requests: Dict[str, int] = {}  # { symbol: requests }
+        self.snapshot_requests = 0
+        self.pacing_violations = 0
+        self.errors = 0
+        self.completed: Dict[str, float] = {}  # { symbol: seconds from start to its first close }
+
+    @property
+    def retries(self) -> int:
+        return sum(count - 1 for count in self.historical_requests.values())
+
+
+class FakeIB:
+    """
+    In-process stand-in for the subset of ib_insync.IB used by IBClient and IBConnection. Historical requests
+    are checked against IB's pacing rules; a request breaking one gets error 162 and no bars, as with TWS.
+    """
+
+    def __init__(self, profile: GatewayProfile, stats: GatewayStats):
+        self.profile = profile
+        self.stats = stats
+        self.errorEvent = Event('errorEvent')
+        self.disconnectedEvent = Event('disconnectedEvent')
+        self._connected = False
+        self._req_id = 0
+        self._last_identical: Dict[Tuple, float] = {}
+        self._per_contract: Dict[int, Deque[float]] = {}
+        self._window: Deque[float] = deque()
+
+    def isConnected(self) -> bool:
+        return self._connected
+
+    async def connectAsync(self, host: str = '127.0.0.1', port: int = 7497, clientId: int = 1,
+                           timeout: float = 4, **kwargs):
+        await asyncio.sleep(self.profile.latency())
+        self._connected = True
+        return self
+
+    def disconnect(self):
+        if self._connected:
+            self._connected = False
+            self.disconnectedEvent.emit()
+
+    async def reqCurrentTimeAsync(self):
+        return time.time()
+
+    def reqMarketDataType(self, marketDataType: int):
+        pass
+
+    def _next_req_id(self) -> int:
+        self._req_id += 1
+        return self._req_id
+
+    def _error(self, req_id: int, error: Tuple[int, str], contract: Optional[Contract]):
+        self.errorEvent.emit(req_id, error[0], error[1], contract)
+
+    async def reqContractDetailsAsync(self, contract: Contract) -> List[ContractDetails]:
+        req_id = self._next_req_id()
+        self.stats.contract_requests += 1
+        await asyncio.sleep(self.profile.latency())
+        if not self.profile.has_contract(contract.symbol):
+            self._error(req_id, NO_CONTRACT, contract)
+            return []
+        conid = int.from_bytes(hashlib.md5(contract.symbol.encode()).digest()[:3], 'big')
+        resolved = Contract(secType='STK', conId=conid, symbol=contract.symbol, exchange='SMART',
+                            primaryExchange='NYSE', currency='USD', localSymbol=contract.symbol)
+        return [ContractDetails(contract=resolved)]
+
+    def _breaks_pacing(self, contract: Contract, durationStr: str, whatToShow: str, now: float) -> bool:
+        profile = self.profile
+        identical = (contract.conId, durationStr, whatToShow)
+        last = self._last_identical.get(identical)
+        self._last_identical[identical] = now
+
+        recent = self._per_contract.setdefault(contract.conId, deque())
+        while recent and recent[0] <= now - profile.per_contract_window_sec:
+            recent.popleft()
+        recent.append(now)
+
+        self._window.append(now)
+        horizon = max(profile.window_sec if profile.window_max_requests else 0, 1)
+        while self._window and self._window[0] <= now - horizon:
+            self._window.popleft()
+
+        return any([
+            last is not None and now - last < profile.identical_interval_sec,
+            len(recent) > profile.per_contract_max,
+            profile.window_max_requests and len(self._window) > profile.window_max_requests,
+            profile.max_rate_per_sec and sum(1 for t in self._window if t > now - 1) > profile.max_rate_per_sec,
+        ])
+
+    async def reqHistoricalDataAsync(self, contract: Contract, endDateTime='', durationStr='1 D',
+                                     barSizeSetting='1 day', whatToShow='TRADES', useRTH=True, formatDate=1,
+                                     **kwargs) -> List[BarData]:
+        req_id = self._next_req_id()
+        stats = self.stats
+        stats.historical_requests[contract.symbol] = stats.historical_requests.get(contract.symbol, 0) + 1
+        if self._breaks_pacing(contract, durationStr, whatToShow, time.monotonic()):
+            stats.pacing_violations += 1
+            self._error(req_id, PACING_VIOLATION, contract)
+            return []
+
+        await asyncio.sleep(self.profile.latency())
+        if self.profile.random.random() < self.profile.error_rate:
+            stats.errors += 1
+            self._error(req_id, NO_DATA, contract)
+            return []
+
+        days = _trading_days(APP.conf.last_trading_day, int(durationStr.split()[0]))
+        bars = [BarData(date=day, close=_close(contract, day)) for day in days]
+        stats.completed.setdefault(contract.symbol, time.monotonic() - stats.started)
+        return bars
+
+    async def reqTickersAsync(self, *contracts: Contract) -> List[Ticker]:
+        self.stats.snapshot_requests += 1
+        await asyncio.sleep(self.profile.latency())
+        tickers = []
+        for contract in contracts:
+            failed = self.profile.random.random() < self.profile.error_rate
+            close = math.nan if failed else _close(contract, APP.conf.last_trading_day)
+            if not failed:
+                self.stats.completed.setdefault(contract.symbol, time.monotonic() - self.stats.started)
+            tickers.append(Ticker(contract=contract, close=close))
+        return tickers
+
+
+@lru_cache(maxsize=None)
+def _trading_days(end_date: date, count: int) -> List[date]:
+    return [date.fromisoformat(day) for day in get_trading_days(end_date, count)]
+
+
+def _close(contract: Contract, day: date) -> float:
+    # a fixed price per symbol and day, so overlapping bar requests and snapshots agree
+    return round(10 + contract.conId % 500 + day.toordinal() % 100 * 0.01, 2)
+
+
+def install(profile: GatewayProfile) -> GatewayStats:
+    """
+    Make IBClient connect to FakeIB instances with the given profile instead of a real gateway.
+    Returns the statistics the connections share.
+    """
+    stats = GatewayStats()
+    ibclient.IB = lambda: FakeIB(profile, stats)
+    return stats
@@ -2,12 +2,11 @@ import asyncio
 import json
 import logging
 import os
-import random
 from datetime import datetime
 
 from app.cache.closing_prices_cache import ClosingPriceCache
 from app.ib.ib_price_fetcher import IBPriceFetcher
-from app.ib.ibclient import IBClient
+from app.ib.ib_connection import IBConnectionManager
 from tests.testing_symbols import test_symbols
 
 logging.basicConfig(level=logging.INFO,
@@ -17,16 +16,18 @@ logger = logging.getLogger(__name__)
 
 class IBPriceFetcherTest:
     def __init__(self):
-        self.client_id = random.randint(1000, 999999)
         self.status_map = {}
 
     async def run(self, symbols):
         logger.info(f"Fetching prices for {len(symbols)} symbols")
 
-        async with IBClient(client_id=self.client_id) as ib_client:
-            fetcher = IBPriceFetcher(ib_client=ib_client)
+        pool = IBConnectionManager()
+        try:
+            fetcher = IBPriceFetcher(pool)
             await fetcher.fetch_prices(symbols)
             self.status_map = fetcher.status_map
+        finally:
+            await pool.close()
 
         await self._report(symbols)
 
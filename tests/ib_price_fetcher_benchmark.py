@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from app.cache.closing_price_store import ParquetClosingPriceStore
+from app.cache.closing_prices_cache import ClosingPriceCache
+from app.cache.contract_metadata_cache import ContractMetadataCache
+from app.cache.fetch_run_store import FetchRunStore
+from app.cache.negative_symbol_cache import NegativeSymbolCache
+from app.config import APP
+import app.ib.ib_price_fetcher as ib_price_fetcher
+from app.ib.ib_connection import IBConnectionManager
+from app.ib.ib_price_fetcher import IBPriceFetcher
+from app.single_flight import SingleFlight
+from tests.fake_ib import GatewayProfile, install
+from tests.testing_symbols import test_symbols
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s - %(name)s - %(levelname)s - [%(threadName)s] - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def make_symbols(count: int):
+    symbols = list(dict.fromkeys(test_symbols))[:count]
+    return symbols + [f"SYN{i:05d}" for i in range(count - len(symbols))]
+
+
+def reset_caches(storage: str):
+    """
+    Give every run empty caches in a scratch directory, so runs do not reuse each other's contracts and prices.
+    """
+    ContractMetadataCache._csv_path = os.path.join(storage, "contract_metadata_db.csv")
+    ContractMetadataCache._legacy_csv_path = os.path.join(storage, "contract_metadata.csv")
+    ContractMetadataCache._instance = None
+    NegativeSymbolCache._csv_path = os.path.join(storage, "negative_symbols.csv")
+    NegativeSymbolCache._instance = None
+    FetchRunStore._dir_path = os.path.join(storage, "fetch_runs")
+    FetchRunStore._instance = None
+    ClosingPriceCache._legacy_csv_path = os.path.join(storage, "closing_prices_log.csv")
+    ClosingPriceCache._instance = ClosingPriceCache(ParquetClosingPriceStore(os.path.join(storage, "closing_prices")))
+    SingleFlight._instance = None
+
+
+async def close_caches():
+    await ContractMetadataCache.instance().close()
+    await NegativeSymbolCache.instance().close()
+    await FetchRunStore.instance().close()
+    await ClosingPriceCache.instance().close()
+
+
+async def run_once(symbols, profile: GatewayProfile, batch_size: int, concurrency: int, pool_size: int) -> dict:
+    APP.conf.ib_batch_size = batch_size
+    APP.conf.ib_max_concurrent_requests = concurrency
+    stats = install(profile)
+    with tempfile.TemporaryDirectory() as storage:
+        reset_caches(storage)
+        pool = IBConnectionManager(pool_size)
+        try:
+            t0 = time.monotonic()
+            stats.started = t0
+            result = await IBPriceFetcher(pool).fetch_prices(symbols)
+            elapsed = time.monotonic() - t0
+            waited_sec = sum(state['pacing']['waited_sec'] + state['market_data']['waited_sec']
+                             for state in pool.connection_states())
+        finally:
+            await pool.close()
+            await close_caches()
+
+    completed = np.array(list(stats.completed.values())) if stats.completed else np.zeros(1)
+    return {
+        'batch_size': batch_size,
+        'concurrency': concurrency,
+        'fetched': len(stats.completed),
+        'failed': len(result.get('fetch_failed', [])) + len(result.get('resolution_failed', [])),
+        'elapsed_sec': elapsed,
+        'symbols_per_sec': len(stats.completed) / elapsed,
+        'p50_sec': float(np.percentile(completed, 50)),
+        'p99_sec': float(np.percentile(completed, 99)),
+        'retries': stats.retries,
+        'pacing_violations': stats.pacing_violations,
+        'pacing_wait_sec': waited_sec,
+    }
+
+
+async def main(args):
+    # the fetcher logs every failed request, keep the report readable by default
+    logging.getLogger().setLevel(args.log_level)
+    APP.conf.ib_pacing_rate_per_sec = args.pacing_rate
+    APP.conf.ib_pacing_burst = max(1, int(args.pacing_rate))
+    APP.conf.ib_max_retries = args.max_retries
+    APP.conf.ib_close_mode = args.close_mode
+    # the simulated snapshots always carry the last trading day's close, whatever the time of day
+    ib_price_fetcher.is_after_market_close = lambda: False
+    symbols = make_symbols(args.symbols)
+    logger.info(f"{len(symbols)} symbols, pool of {args.pool_size}, latency p50 {args.latency_ms}ms "
+                f"p99 {args.latency_p99_ms}ms, error rate {args.error_rate}, pacing {args.pacing_rate} req/s")
+    logger.info(f"{'batch':>6} {'conc':>5} {'fetched':>8} {'failed':>7} {'secs':>8} {'sym/s':>8} "
+                f"{'p50 s':>7} {'p99 s':>7} {'retries':>8} {'violations':>11} {'paced s':>8}")
+    for batch_size in args.batch_sizes:
+        for concurrency in args.concurrency:
+            profile = GatewayProfile(latency_ms=args.latency_ms, latency_p99_ms=args.latency_p99_ms,
+                                     error_rate=args.error_rate, no_contract_rate=args.no_contract_rate,
+                                     max_rate_per_sec=args.gateway_rate, seed=args.seed)
+            r = await run_once(symbols, profile, batch_size, concurrency, args.pool_size)
+            logger.info(f"{r['batch_size']:>6} {r['concurrency']:>5} {r['fetched']:>8} {r['failed']:>7} "
+                        f"{r['elapsed_sec']:>8.2f} {r['symbols_per_sec']:>8.1f} {r['p50_sec']:>7.2f} "
+                        f"{r['p99_sec']:>7.2f} {r['retries']:>8} {r['pacing_violations']:>11} "
+                        f"{r['pacing_wait_sec']:>8.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IBPriceFetcher throughput against a simulated IB gateway")
+    parser.add_argument('--symbols', type=int, default=len(set(test_symbols)))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[25, 50, 100])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--pool-size', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--latency-p99-ms', type=float, default=400)
+    parser.add_argument('--error-rate', type=float, default=0.01, help="share of requests answered with an error")
+    parser.add_argument('--no-contract-rate', type=float, default=0.01, help="share of symbols IB cannot resolve")
+    parser.add_argument('--gateway-rate', type=float, default=50,
+                        help="requests per second above which the gateway reports pacing violations, 0 disables it")
+    parser.add_argument('--pacing-rate', type=float, default=APP.conf.ib_pacing_rate_per_sec,
+                        help="client side pacing limit in requests per second")
+    parser.add_argument('--max-retries', type=int, default=APP.conf.ib_max_retries)
+    parser.add_argument('--close-mode', choices=['historical', 'snapshot'], default='historical')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--log-level', default='CRITICAL', help="level of the fetcher's own log records")
+    asyncio.run(main(parser.parse_args()))